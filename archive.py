@@ -0,0 +1,403 @@
+import bisect
+import hashlib
+import io
+import json
+import mmap
+import os
+import posixpath
+import struct
+import zipfile
+
+WAD_HEADER = struct.Struct('<4sII')
+WAD_DIRENT = struct.Struct('<II8s')
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_LOCAL_MAGIC = b'PK\003\004'
+
+
+def map_source(source):
+    """
+    Return a read-only buffer over the whole of source without copying it
+    where possible. Real files are memory-mapped, buffers are used as is and
+    anything else (e.g. a ZipExtFile) is read once.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return source
+    try:
+        fileno = source.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fileno = None
+    if fileno is not None:
+        try:
+            return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and pipes can't be mapped
+            pass
+    if source.seekable():
+        source.seek(0)
+    return source.read()
+
+
+class LumpView(io.RawIOBase):
+    """
+    Seekable, read-only file object over a slice of a larger buffer.
+    getbuffer() hands out the underlying memoryview without copying.
+    """
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def getbuffer(self):
+        return self._view
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError('invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        data = self._view[self._pos:self._pos + len(b)]
+        n = len(data)
+        b[:n] = data
+        self._pos += n
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end].tobytes()
+        self._pos = max(self._pos, end)
+        return data
+
+    def readall(self):
+        return self.read()
+
+
+class ArchiveIndex(object):
+    """
+    Directory tree over archive member names, built once so the usual scans
+    ("every S_SKIN folder", "every .wad under maps/", "every O_* lump")
+    are lookups instead of passes over namelist(). Flat WAD directories are
+    simply a tree with everything at the root.
+    """
+    def __init__(self, names):
+        self._root = ({}, [])
+        self._by_basename = {}
+        self._by_suffix = {}
+        basenames = set()
+        for name in names:
+            if name.endswith('/'):
+                continue
+            parts = name.split('/')
+            node = self._root
+            for part in parts[:-1]:
+                node = node[0].setdefault(part, ({}, []))
+            node[1].append(name)
+            basename = parts[-1]
+            basenames.add(basename)
+            self._by_basename.setdefault(basename, []).append(name)
+            suffix = posixpath.splitext(basename)[1].lower()
+            self._by_suffix.setdefault(suffix, []).append(name)
+        self._basenames = sorted(basenames)
+
+    def _node(self, directory):
+        node = self._root
+        for part in directory.strip('/').split('/'):
+            if not part:
+                continue
+            if part not in node[0]:
+                return None
+            node = node[0][part]
+        return node
+
+    def named(self, basename):
+        return list(self._by_basename.get(basename, ()))
+
+    def folders_containing(self, basename):
+        return sorted({posixpath.dirname(name) for name in self.named(basename)})
+
+    def with_suffix(self, suffix):
+        return list(self._by_suffix.get(suffix.lower(), ()))
+
+    def files_under(self, directory, suffix=None):
+        node = self._node(directory)
+        names = []
+        stack = [node] if node else []
+        while stack:
+            (dirs, files) = stack.pop()
+            names.extend(files)
+            stack.extend(dirs.values())
+        if suffix is not None:
+            suffix = suffix.lower()
+            names = [name for name in names if name.lower().endswith(suffix)]
+        return sorted(names)
+
+    def basename_prefix(self, prefix):
+        names = []
+        i = bisect.bisect_left(self._basenames, prefix)
+        while i < len(self._basenames) and self._basenames[i].startswith(prefix):
+            names.extend(self._by_basename[self._basenames[i]])
+            i += 1
+        return names
+
+
+class WadFile(object):
+    def __init__(self, source=None, filename=None, directory=None):
+        self._files = {}
+        self._owned = source is None
+        if source is None:
+            source = open(filename, 'rb')
+        self._source = source
+        self.filename = filename or getattr(source, 'name', None)
+        self._data = map_source(source)
+        self._view = memoryview(self._data)
+        if directory is not None:
+            self._files = dict(directory)
+            return
+        (magic, numFiles, dirOffset) = WAD_HEADER.unpack_from(self._view, 0)
+        directory = self._view[dirOffset:dirOffset + numFiles * WAD_DIRENT.size]
+        for (pos, size, name) in WAD_DIRENT.iter_unpack(directory):
+            name = name.replace(b'\0', b'').decode()
+            self._files[name] = { "pos": pos, "size": size }
+
+    def namelist(self):
+        return self._files.keys()
+
+    def directory(self):
+        return self._files
+
+    def directory_digest(self):
+        (magic, numFiles, dirOffset) = WAD_HEADER.unpack_from(self._view, 0)
+        digest = hashlib.sha1(self._view[:WAD_HEADER.size])
+        digest.update(self._view[dirOffset:dirOffset + numFiles * WAD_DIRENT.size])
+        return digest.hexdigest()
+
+    def getinfo(self, name):
+        return self._files[name]
+
+    def read(self, name):
+        """Return the lump as a memoryview into the mapped file (no copy)."""
+        dirent = self._files[name]
+        return self._view[dirent['pos']:dirent['pos'] + dirent['size']]
+
+    def open(self, name, mode='r'):
+        return LumpView(self.read(name))
+
+    def close(self):
+        self._view.release()
+        if isinstance(self._data, mmap.mmap):
+            try:
+                self._data.close()
+            except BufferError:
+                # A lump view is still alive; the mapping goes with it
+                pass
+        if self._owned:
+            self._source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class Pk3File(zipfile.ZipFile):
+    """
+    ZipFile with cheap random access to the archives nested inside it.
+    Stored members are sliced straight out of the memory-mapped outer file,
+    deflated members are inflated once into a buffer that is then reused
+    for every lump read, so nothing ever seeks backwards in a ZipExtFile.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._outer = None
+
+    def _outer_view(self):
+        if self._outer is None:
+            self._outer = memoryview(map_source(self.fp))
+        return self._outer
+
+    def member_view(self, name):
+        info = self.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return memoryview(self.read(info))
+        view = self._outer_view()
+        header = ZIP_LOCAL_HEADER.unpack_from(view, info.header_offset)
+        if header[0] != ZIP_LOCAL_MAGIC:
+            raise zipfile.BadZipFile('Bad magic number for file header')
+        start = info.header_offset + ZIP_LOCAL_HEADER.size + header[10] + header[11]
+        return view[start:start + info.compress_size]
+
+    def open_wad(self, name, directory=None):
+        return WadFile(self.member_view(name), directory=directory)
+
+    def directory_digest(self):
+        # The central directory carries every member's name, size and CRC,
+        # so hashing it fingerprints the archive contents without reading them
+        return hashlib.sha1(self._outer_view()[self.start_dir:]).hexdigest()
+
+    def close(self):
+        if self._outer is not None:
+            self._outer.release()
+            self._outer = None
+        super().close()
+
+
+def open_archive(filename):
+    """Open a .pk3 as a Pk3File and anything else (.wad, .kart) as a WadFile."""
+    if zipfile.is_zipfile(filename):
+        return Pk3File(filename, 'r')
+    return WadFile(filename=filename)
+
+
+def lump_hash(archive, name):
+    """Fingerprint of a member's contents, cheap for zip members."""
+    if isinstance(archive, zipfile.ZipFile):
+        # The zip directory already holds a checksum of every member
+        info = archive.getinfo(name)
+        return f'crc32:{info.CRC:08x}:{info.file_size}'
+    return 'sha1:' + hashlib.sha1(archive.read(name)).hexdigest()
+
+
+def default_cache_dir():
+    """
+    DRRR_UTILS_CACHE overrides the cache location; setting it to an empty
+    string disables the on-disk index cache.
+    """
+    if 'DRRR_UTILS_CACHE' in os.environ:
+        return os.environ['DRRR_UTILS_CACHE'] or None
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'drrr-utils')
+
+
+class IndexCache(object):
+    """
+    Persistent per-archive index keyed on path, size, mtime and a hash of
+    the archive directory. Holds the lump directory, nested WAD directories
+    and any parsed tables (Lua skincolors) so repeat runs over an unchanged
+    addon skip the rescans. Content tables (parsed SOCs and MUSICDEFs) are
+    keyed on the member's own hash instead and outlive changes to the rest
+    of the archive.
+    """
+    VERSION = 2
+
+    def __init__(self, archive, path, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self._archive = archive
+        self._dirty = False
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self._key = {
+            "version": self.VERSION,
+            "path": path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": archive.directory_digest(),
+        }
+        self._file = None
+        self._index = None
+        self._used = {}
+        self._carried = False
+        if cache_dir:
+            name = hashlib.sha1(path.encode()).hexdigest() + '.json'
+            self._file = os.path.join(cache_dir, name)
+        self._entry = self._load()
+
+    def _load(self):
+        content = {}
+        if self._file and os.path.isfile(self._file):
+            try:
+                with open(self._file, 'r') as f:
+                    entry = json.load(f)
+                if entry.get("key") == self._key:
+                    return entry
+                if entry.get("key", {}).get("version") == self.VERSION:
+                    content = entry.get("content", {})
+                    self._carried = True
+            except (OSError, ValueError, AttributeError):
+                pass
+        self._dirty = True
+        return {"key": self._key, "namelist": list(self._archive.namelist()), "wads": {}, "tables": {}, "content": content}
+
+    def namelist(self):
+        return self._entry["namelist"]
+
+    def index(self):
+        if self._index is None:
+            self._index = ArchiveIndex(self.namelist())
+        return self._index
+
+    def wad_directory(self, name):
+        return self._entry["wads"].get(name)
+
+    def add_wad_directory(self, name, directory):
+        if name not in self._entry["wads"]:
+            self._entry["wads"][name] = directory
+            self._dirty = True
+
+    def open_wad(self, name):
+        wad = self._archive.open_wad(name, self.wad_directory(name))
+        self.add_wad_directory(name, wad.directory())
+        return wad
+
+    def table(self, kind, name, build):
+        """Return the cached table for member name, calling build() on a miss."""
+        tables = self._entry["tables"].setdefault(kind, {})
+        if name not in tables:
+            tables[name] = build()
+            self._dirty = True
+        return tables[name]
+
+    def content_table(self, kind, digest, build):
+        """Return the cached table for contents with this digest, calling build() on a miss."""
+        tables = self._entry["content"].setdefault(kind, {})
+        self._used.setdefault(kind, set()).add(digest)
+        if digest not in tables:
+            tables[digest] = build()
+            self._dirty = True
+        return tables[digest]
+
+    def save(self):
+        # When the archive changed, drop the content tables of members that
+        # changed or went with it, for the kinds this run looked at
+        for (kind, used) in (self._used.items() if self._carried else ()):
+            tables = self._entry["content"][kind]
+            for digest in list(tables):
+                if digest not in used:
+                    del tables[digest]
+                    self._dirty = True
+        if not self._file or not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self._file), exist_ok=True)
+        tmp = self._file + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(self._entry, f)
+        os.replace(tmp, self._file)
+        self._dirty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.save()
@@ -0,0 +1,167 @@
+import os
+import re
+import struct
+
+# Opus always decodes at 48 kHz whatever input rate the header records
+OPUS_SAMPLE_RATE = 48000
+# Enough of a lump to see every signature sniff() knows, the deepest being
+# the MOD tag at offset 1080
+SNIFF_SIZE = 1084
+# probe_file() reads this much from the start (and for Ogg the end) of a file
+PROBE_SIZE = 65536
+MODULE_FORMATS = ('it', 'xm', 's3m', 'mod')
+MOD_TAGS = (b'M.K.', b'M!K!', b'M&K!', b'FLT4', b'FLT8', b'CD81', b'OKTA', b'OCTA')
+MOD_TAG_PATTERN = re.compile(rb'\dCHN|\d\dCH|TDZ\d')
+
+
+def read_wav_header(stream):
+    """
+    Read a RIFF/WAVE header off a stream up to the start of the sample data.
+    Returns the header bytes, to be passed on unchanged, and the parsed
+    probe info (see probe()).
+    """
+    header = stream.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        raise ValueError('Not a WAV stream')
+    info = None
+    while True:
+        chunk = stream.read(8)
+        if len(chunk) < 8:
+            raise ValueError('Truncated WAV header')
+        header += chunk
+        (chunk_id, size) = struct.unpack('<4sI', chunk)
+        if chunk_id == b'data':
+            break
+        body = stream.read(size + (size & 1))
+        header += body
+        if chunk_id == b'fmt ' and len(body) >= 16:
+            info = wav_format(body)
+    if info is None:
+        raise ValueError('WAV stream has no fmt chunk')
+    if info['block_align']:
+        info['duration'] = size / (info['block_align'] * info['sample_rate'])
+    return (header, info)
+
+
+def wav_format(body):
+    (tag, channels, sample_rate, byte_rate, block_align) = struct.unpack_from('<HHIIH', body)
+    return {
+        'format': 'wav',
+        'sample_rate': sample_rate,
+        'channels': channels,
+        'duration': None,
+        'block_align': block_align,
+    }
+
+
+def probe_wav(data):
+    pos = 12
+    info = None
+    while pos + 8 <= len(data):
+        (chunk_id, size) = struct.unpack_from('<4sI', data, pos)
+        body = data[pos + 8:pos + 8 + size]
+        if chunk_id == b'fmt ' and len(body) >= 16:
+            info = wav_format(body)
+        elif chunk_id == b'data' and info and info['block_align']:
+            info['duration'] = size / (info['block_align'] * info['sample_rate'])
+            break
+        pos += 8 + size + (size & 1)
+    return info
+
+
+def last_granule(data):
+    # The last page's granule position is the stream length in samples
+    pos = data.rfind(b'OggS', max(0, len(data) - 65536))
+    if pos < 0 or pos + 14 > len(data):
+        return None
+    return struct.unpack_from('<q', data, pos + 6)[0]
+
+
+def probe_ogg(data, tail=None):
+    if tail is None:
+        tail = data
+    segments = data[26]
+    packet = data[27 + segments:]
+    if packet[:7] == b'\x01vorbis':
+        (channels, sample_rate) = struct.unpack_from('<BI', packet, 11)
+        info = {'format': 'ogg', 'codec': 'vorbis', 'sample_rate': sample_rate, 'channels': channels, 'duration': None}
+        granule = last_granule(tail)
+        if granule and granule > 0 and sample_rate:
+            info['duration'] = granule / sample_rate
+        return info
+    if packet[:8] == b'OpusHead':
+        (channels, pre_skip) = struct.unpack_from('<BH', packet, 9)
+        info = {'format': 'ogg', 'codec': 'opus', 'sample_rate': OPUS_SAMPLE_RATE, 'channels': channels, 'duration': None}
+        granule = last_granule(tail)
+        if granule and granule > pre_skip:
+            info['duration'] = (granule - pre_skip) / OPUS_SAMPLE_RATE
+        return info
+    return None
+
+
+def sniff(data):
+    """
+    Identify an audio lump from its first SNIFF_SIZE bytes, checking every
+    signature at the offset the format actually puts it. Returns the usual
+    file extension (without the dot) or None when nothing matches.
+    """
+    data = bytes(data[:SNIFF_SIZE])
+    if data[:4] == b'OggS':
+        if len(data) > 26 and data[27 + data[26]:].startswith(b'OpusHead'):
+            return 'opus'
+        return 'ogg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+        return 'wav'
+    if data[:4] == b'fLaC':
+        return 'flac'
+    if data[:4] == b'IMPM':
+        return 'it'
+    if data[:17] == b'Extended Module: ':
+        return 'xm'
+    if data[44:48] == b'SCRM':
+        return 's3m'
+    tag = data[1080:1084]
+    if tag in MOD_TAGS or (len(tag) == 4 and MOD_TAG_PATTERN.fullmatch(tag)):
+        return 'mod'
+    # ID3v2 tag or a bare MPEG audio layer III frame sync
+    if data[:3] == b'ID3' or (len(data) > 1 and data[0] == 0xFF and data[1] & 0xE6 == 0xE2):
+        return 'mp3'
+    return None
+
+
+def probe(data):
+    """
+    Read the sample rate, channel count and (when the header holds it) the
+    duration in seconds of an audio lump from its bytes. Returns None when
+    the format isn't recognised, in which case ffprobe has to be asked.
+    Tracker modules always go to ffprobe: the rate they render at depends on
+    which module library ffmpeg was built with.
+    """
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    try:
+        format = sniff(data)
+        if format == 'wav':
+            return probe_wav(data)
+        if format in ('ogg', 'opus'):
+            return probe_ogg(data)
+    except (struct.error, IndexError):
+        pass
+    return None
+
+
+def probe_file(path):
+    """
+    probe() a file on disk reading only its first PROBE_SIZE bytes, plus the
+    last PROBE_SIZE for an Ogg stream's final granule position.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(PROBE_SIZE)
+        info = probe(head)
+        if info and info['format'] == 'ogg' and len(head) == PROBE_SIZE:
+            f.seek(-min(PROBE_SIZE, os.fstat(f.fileno()).st_size), os.SEEK_END)
+            try:
+                info = probe_ogg(head, f.read())
+            except (struct.error, IndexError):
+                pass
+    return info
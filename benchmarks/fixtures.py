@@ -0,0 +1,177 @@
+"""
+Synthetic stand-ins for the game data the extractors read, so they can be
+timed without the copyrighted originals. Every generator takes its sizes as
+arguments and a seed, so the same arguments always build the same archive.
+"""
+import io
+import os
+import random
+import struct
+import sys
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from archive import WAD_HEADER, WAD_DIRENT
+from graphics import PATCH_HEADER
+
+MAP_TYPES = ('Race', 'Race', 'Versus', 'Battle')
+MUSIC_FORMATS = ('ogg', 'it', 'xm', 's3m', 'mod')
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, 'little') if size else b''
+
+
+def make_wad(lumps):
+    """Build a PWAD from (name, data) pairs."""
+    data = bytearray(WAD_HEADER.size)
+    entries = []
+    for (name, lump) in lumps:
+        entries.append((len(data), len(lump), name.encode()))
+        data += lump
+    directory = len(data)
+    for entry in entries:
+        data += WAD_DIRENT.pack(*entry)
+    WAD_HEADER.pack_into(data, 0, b'PWAD', len(entries), directory)
+    return bytes(data)
+
+
+def make_patch(rng, width, height, coverage=0.8):
+    """
+    Build a Doom patch whose columns are runs of posts separated by
+    transparent gaps, roughly coverage of the pixels being opaque.
+    """
+    columns = []
+    for x in range(width):
+        column = bytearray()
+        y = 0
+        while y < height and y < 255:
+            if rng.random() > coverage:
+                y += rng.randint(1, 8)
+                continue
+            count = min(rng.randint(1, 64), height - y, 255 - y)
+            column += bytes((y, count, 0)) + random_bytes(rng, count) + b'\0'
+            y += count
+        column += b'\xff'
+        columns.append(bytes(column))
+    offset = PATCH_HEADER.size + 4 * width
+    offsets = []
+    for column in columns:
+        offsets.append(offset)
+        offset += len(column)
+    header = PATCH_HEADER.pack(width, height, 0, 0) + struct.pack('<%dI' % width, *offsets)
+    return header + b''.join(columns)
+
+
+def make_png(rng, width, height):
+    image = Image.frombytes('P', (width, height), random_bytes(rng, width * height))
+    image.putpalette(random_bytes(rng, 768))
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+
+def make_bios(path, seed=0):
+    """bios.pk3 holding a PLAYPAL of 14 palettes."""
+    rng = random.Random(seed)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('PLAYPAL', random_bytes(rng, 768 * 14))
+    return path
+
+
+def make_character_pack(path, characters=8, colors=8, seed=0):
+    """
+    Character pack with one folder per character (S_SKIN and an XTRAB0
+    patch) and a Lua script freeslotting extra skincolors.
+    """
+    rng = random.Random(seed)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for i in range(characters):
+            folder = 'char%02d' % i
+            z.writestr(folder + '/S_SKIN', 'name = bench%02d\nrealname = Bench %d\nstartcolor = 96\nprefcolor = white\n' % (i, i))
+            z.writestr(folder + '/XTRAB0', make_patch(rng, 32, 32))
+        lua = ''
+        for i in range(colors):
+            ramp = ', '.join(str(rng.randrange(256)) for _ in range(16))
+            lua += 'freeslot("SKINCOLOR_BENCH%d")\n' % i
+            lua += 'skincolors[SKINCOLOR_BENCH%d] = {\n' % i
+            lua += '\tname = "Bench%d",\n\tramp = {%s},\n\tinvcolor = SKINCOLOR_WHITE,\n\tinvshade = 9,\n\tchatcolor = V_BLUEMAP,\n\taccessible = true\n}\n\n' % (i, ramp)
+        z.writestr('Lua/skincolors.lua', lua)
+    return path
+
+
+def make_map_pack(path, maps=32, width=320, height=200, png_every=8, socs=2, seed=0):
+    """
+    Map pack of nested WADs under maps/ (every other one stored rather than
+    deflated, as real packs mix both) with a PICTURE patch, or every
+    png_every-th map a PNG PICTURE, an ENCORE colormap on half of them and
+    the level headers split across socs SOC files.
+    """
+    rng = random.Random(seed)
+    soc = [''] * socs
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for i in range(maps):
+            name = 'RR_MAP%03d' % i
+            map_type = MAP_TYPES[i % len(MAP_TYPES)]
+            if png_every and i % png_every == png_every - 1:
+                picture = make_png(rng, width, height)
+            else:
+                picture = make_patch(rng, width, height)
+            lumps = [(name, b''), ('THINGS', random_bytes(rng, 10 * 64)), ('PICTURE', picture)]
+            if i % 2 == 0:
+                lumps.append(('ENCORE', random_bytes(rng, 256 * 32)))
+            compress_type = zipfile.ZIP_STORED if i % 2 else zipfile.ZIP_DEFLATED
+            z.writestr('maps/%s/%s.wad' % (map_type.lower(), name), make_wad(lumps), compress_type)
+            soc[i % socs] += 'Level %s\n# Generated\nLevelName = Bench %d\nAct = %d\nTypeOfLevel = %s\nMenuTitle = Menu\n\n' % (name, i, i % 3 + 1, map_type)
+        for (i, text) in enumerate(soc):
+            z.writestr('soc/levels%d.soc' % i, text)
+    return path
+
+
+def make_ogg(rng, size):
+    ident = b'\x01vorbis' + struct.pack('<IBI', 0, 2, 44100) + bytes(12) + b'\x01'
+    page = b'OggS' + bytes(22) + bytes((1, len(ident))) + ident
+    last = b'OggS\x00\x04' + struct.pack('<q', 44100 * 120) + bytes(12) + b'\x00'
+    return page + random_bytes(rng, max(0, size - len(page) - len(last))) + last
+
+
+def make_module(rng, format, size):
+    data = bytearray(random_bytes(rng, max(size, 1084)))
+    if format == 'it':
+        data[0:4] = b'IMPM'
+    elif format == 'xm':
+        data[0:17] = b'Extended Module: '
+    elif format == 's3m':
+        data[44:48] = b'SCRM'
+    elif format == 'mod':
+        data[1080:1084] = b'M.K.'
+    return bytes(data)
+
+
+def make_music_pack(path, songs=64, size=256 * 1024, seed=0):
+    """
+    Music pack of O_ lumps cycling through Ogg and the tracker module
+    formats, half of them without an extension so they have to be sniffed,
+    plus a MUSICDEF with one multi-lump entry per eight songs.
+    """
+    rng = random.Random(seed)
+    musicdef = ''
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        i = 0
+        while i < songs:
+            format = MUSIC_FORMATS[i % len(MUSIC_FORMATS)]
+            keys = ['BN%03d' % i]
+            if i % 8 == 7 and i + 1 < songs:
+                keys.append('BN%03d' % (i + 1))
+            for key in keys:
+                data = make_ogg(rng, size) if format == 'ogg' else make_module(rng, format, size)
+                name = 'Music/O_%s' % key
+                if i % 2:
+                    name += '.' + format
+                z.writestr(name, data)
+            musicdef += 'Lump %s\nTitle = Bench Song %d\nAuthor = Bench\nVolume = %d\n\n' % (','.join(keys), i, rng.randint(50, 100))
+            i += len(keys)
+        z.writestr('MUSICDEF', musicdef)
+    return path
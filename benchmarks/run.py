@@ -0,0 +1,190 @@
+#!/bin/env python3
+"""
+Time the extractors against synthetic fixtures (see fixtures.py), giving
+reproducible before/after numbers without any game data:
+
+    python benchmarks/run.py --preset medium --repeat 5 --json before.json
+
+Only in-process work is timed; nothing here runs vgmstream-cli, ffmpeg or
+lua, so the numbers are the Python side of each tool.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import extract_maps
+import extract_music
+import extract_skins
+from archive import Pk3File, ArchiveIndex
+from graphics import format_list, scale_list
+
+presets = {
+    "small":  {"characters": 4,  "colors": 4,  "maps": 8,   "songs": 16,  "song_size": 64 * 1024},
+    "medium": {"characters": 16, "colors": 8,  "maps": 32,  "songs": 64,  "song_size": 256 * 1024},
+    "large":  {"characters": 64, "colors": 16, "maps": 128, "songs": 256, "song_size": 1024 * 1024},
+}
+
+
+def build_fixtures(directory, sizes):
+    return {
+        "bios": fixtures.make_bios(os.path.join(directory, 'bios.pk3')),
+        "chars": fixtures.make_character_pack(os.path.join(directory, 'chars.pk3'), sizes["characters"], sizes["colors"]),
+        "maps": fixtures.make_map_pack(os.path.join(directory, 'maps.pk3'), sizes["maps"]),
+        "music": fixtures.make_music_pack(os.path.join(directory, 'music.pk3'), sizes["songs"], sizes["song_size"]),
+    }
+
+
+def read_palette(bios):
+    # Same palette lists the extract_maps CLI builds from PLAYPAL
+    palette = []
+    with bios.open('PLAYPAL', 'r') as f:
+        for i in range(256):
+            [r, g, b] = f.read(3)
+            palette.append([r, g, b])
+    pal = [channel for color in palette for channel in color]
+    return (palette, pal)
+
+
+def bench_convert_doom_to_png(paths, output_location, args):
+    with zipfile.ZipFile(paths["bios"]) as bios, Pk3File(paths["chars"]) as addon:
+        palettes = extract_skins.SkinPalettes(extract_skins.read_playpal(bios))
+        for folder_name in ArchiveIndex(addon.namelist()).folders_containing('S_SKIN'):
+            folder_path = os.path.join(output_location, folder_name)
+            os.makedirs(folder_path, exist_ok=True)
+            for size in args.size:
+                for color in extract_skins.skincolors:
+                    with addon.open(folder_name + '/XTRAB0') as image:
+                        extract_skins.convert_doom_to_png(bios, image, folder_path, 96, color, size, palettes=palettes)
+
+
+def bench_extract_character(paths, output_location, args):
+    with zipfile.ZipFile(paths["bios"]) as bios, Pk3File(paths["chars"]) as addon:
+        palettes = extract_skins.SkinPalettes(extract_skins.read_playpal(bios))
+        for folder_name in ArchiveIndex(addon.namelist()).folders_containing('S_SKIN'):
+            extract_skins.extract_character(addon, folder_name, palettes, output_location, args.size, formats=args.format)
+
+
+def bench_extract_maps(paths, output_location, args):
+    with zipfile.ZipFile(paths["bios"]) as bios, Pk3File(paths["maps"]) as pk3:
+        (palette, pal) = read_palette(bios)
+        extract_maps.open_pack(pk3, palette, pal, output_location, args.scale, formats=args.format)
+
+
+def bench_map_level_names(paths, output_location, args):
+    with Pk3File(paths["maps"]) as pk3:
+        levels = {}
+        for soc_name in ArchiveIndex(pk3.namelist()).files_under('soc/'):
+            extract_maps.get_level_names(pk3, levels, soc_name)
+
+
+def bench_music_level_names(paths, output_location, args):
+    with Pk3File(paths["music"]) as pk3:
+        songs = {}
+        for soc_name in ArchiveIndex(pk3.namelist()).basename_prefix("MUSICDEF"):
+            extract_music.get_level_names(pk3, songs, soc_name)
+
+
+def bench_music_plan(paths, output_location, args):
+    # Everything extract_music does before the first song is converted
+    music_args = SimpleNamespace(addon=paths["music"], output_location=output_location, catalog=[],
+                                 file_type='mp3', encore=False, with_encore=False, loop_count=[1],
+                                 original_volume=False)
+    with Pk3File(paths["music"]) as pk3:
+        index = ArchiveIndex(pk3.namelist())
+        songs = {}
+        for soc_name in index.basename_prefix("MUSICDEF"):
+            extract_music.get_level_names(pk3, songs, soc_name)
+        report = extract_music.match_music_lumps(index.basename_prefix("O_"), songs)
+        variants = extract_music.get_variants(music_args)
+        extract_music.plan_music(pk3, report["matches"], songs, variants, music_args)
+
+
+benchmarks = [
+    ("skins: convert_doom_to_png", bench_convert_doom_to_png),
+    ("skins: extract_character", bench_extract_character),
+    ("maps: extract loop", bench_extract_maps),
+    ("maps: get_level_names", bench_map_level_names),
+    ("music: get_level_names", bench_music_level_names),
+    ("music: plan", bench_music_plan),
+]
+
+
+def run(name, bench, paths, workdir, args):
+    times = []
+    for i in range(args.repeat):
+        output_location = tempfile.mkdtemp(prefix='out-', dir=workdir)
+        # The extractors print every file they write
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            bench(paths, output_location, args)
+            times.append(time.perf_counter() - start)
+    return {
+        "name": name,
+        "runs": len(times),
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "times": times,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the extractors against synthetic fixtures.")
+    parser.add_argument('-p', '--preset', choices=sorted(presets), default='small', help='Fixture sizes (default: small)')
+    parser.add_argument('--characters', type=int, help='Characters in the character pack (default: from preset)')
+    parser.add_argument('--colors', type=int, help='Extra Lua skincolors in the character pack (default: from preset)')
+    parser.add_argument('--maps', type=int, help='WADs in the map pack (default: from preset)')
+    parser.add_argument('--songs', type=int, help='O_ lumps in the music pack (default: from preset)')
+    parser.add_argument('--song-size', type=int, help='Bytes per O_ lump (default: from preset)')
+    parser.add_argument('-s', '--size', type=scale_list, default=[1], help='Skin size multipliers, e.g. 1,2,4 (default: 1)')
+    parser.add_argument('--scale', type=scale_list, default=[1], help='Map size multipliers, e.g. 1,2,4 (default: 1)')
+    parser.add_argument('-f', '--format', type=format_list, default=['png'], help='Image formats, e.g. png,webp (default: png)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of each benchmark (default: 3)')
+    parser.add_argument('-k', '--filter', type=str, default='', help='Only run benchmarks whose name contains this (default: all)')
+    parser.add_argument('-w', '--workdir', type=str, help='Keep fixtures and outputs here instead of a temporary directory (default: None)')
+    parser.add_argument('--json', type=str, metavar='PATH', help='Also write the results to PATH as JSON (default: None)')
+    args = parser.parse_args()
+
+    sizes = dict(presets[args.preset])
+    for key in sizes:
+        if getattr(args, key) is not None:
+            sizes[key] = getattr(args, key)
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory(prefix='drrr-bench-'))
+        os.makedirs(workdir, exist_ok=True)
+        start = time.perf_counter()
+        paths = build_fixtures(workdir, sizes)
+        print(f'Fixtures: \t {args.preset} {sizes} built in {time.perf_counter() - start:.2f}s')
+
+        results = []
+        for (name, bench) in benchmarks:
+            if args.filter not in name:
+                continue
+            result = run(name, bench, paths, workdir, args)
+            results.append(result)
+            print(f'{name:<28} min {result["min"]:8.4f}s  median {result["median"]:8.4f}s  ({result["runs"]} runs)')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                "preset": args.preset,
+                "sizes": sizes,
+                "size": args.size,
+                "scale": args.scale,
+                "format": args.format,
+                "python": platform.python_version(),
+                "results": results,
+            }, f, indent=4)
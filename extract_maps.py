@@ -1,67 +1,200 @@
 #!/bin/env python3
-import sys
 import zipfile
 import os
-import re
-import io
-import struct
+import argparse
 from PIL import Image, ImageOps
 from pathlib import Path
+from archive import Pk3File, ArchiveIndex, IndexCache
+from soc import read_soc
+import workers
+from graphics import decode_patch, indexed_image, format_list, save_formats, scale_list, scale_suffix
 
-class WadFile(object):
-    def __init__(self, source=None, filename=None):
-        self._files = {}
-        if not source:
-            source = open(filename, 'rb')
-        self._source = source
-        header = source.read(12)
-        (magic, numFiles, dirOffset) = struct.unpack('<III', header)
-        source.seek(dirOffset)
-        for i in range(numFiles):
-            dirent = source.read(16)
-            (pos, size, name) = struct.unpack('<II8s', dirent)
-            name = name.replace(b'\0', b'').decode()
-            self._files[name] = { "pos": pos, "size": size }
-
-    def namelist(self):
-        return self._files.keys()
-
-    def open(self, name, mode='r'):
-        dirent = self._files[name]
-        self._source.seek(dirent['pos'])
-        return io.BytesIO(self._source.read(dirent['size']))
-
-def get_level_names(pk3, levels, soc):
-    currentLevel = None
-    with pk3.open(soc) as file:
-        # Read the entire file content as bytes
-        file_content_bytes = file.read()
-        # Decode bytes to string using UTF-8 encoding (or appropriate encoding for your file)
-        file_content = file_content_bytes.decode('utf-8')
-        for line in file_content.splitlines():
-            # print(line)
-            # print(line, line.startswith('Level'), line.startswith('#'), '=' in line)
-            if line.startswith('Level '):
-                currentLevel = line.split(' ')[1].lower()
-                # currentLevel = line.replace('=', ' ').strip().split(' ')[-1]
-                levels[currentLevel] = {}
-                continue
-            elif not currentLevel or line.startswith('#') or '=' not in line:
-                continue
-            [key, value] = line.split('=')
-            levels[currentLevel][key.strip().lower()] = value.strip()
-            # print(currentLevel)
+def get_level_names(pk3, levels, soc, cache=None):
+    levels.update(read_soc(pk3, soc, cache)["levels"])
     return levels
 
-if __name__ == "__main__":
-    if len(sys.argv) < 4 or len(sys.argv) > 5:
-        print("Usage: python extract_skins.py <bios.pk3 file> <pack> <output folder> <size multiplier>")
-        sys.exit(1)
-    bios_arg = sys.argv[1]
-    doom_file = sys.argv[2]
-    output_location = sys.argv[3]
-    scale = 1 if len(sys.argv) == 4 else int(sys.argv[4])
+def get_map_title(wad_name, levels):
+    true_name = Path(wad_name).stem
+    map_type = ""
+    # print(true_name)
+    if true_name.lower() in levels:
+        level = levels[true_name.lower()]
+        if 'zonetitle' in level:
+            true_name = '%s %s' % (level['levelname'], level['zonetitle'])
+        elif 'nozone' in level and level['nozone'] == 'True':
+            true_name = level['levelname']
+        else:
+            true_name = '%s Zone' % (level['levelname'])
+        if 'act' in level:
+            true_name += ' %s' % (level['act'])
+        elif 'menutitle' in level:
+            true_name += ' %s' % (level['menutitle'])
+
+        if 'typeoflevel' in level:
+            map_type = level['typeoflevel'].lower()
+    return (true_name, map_type)
+
+def extract_map(wad, true_name, map_type, palette, pal, output_location, scales, formats=('png',)):
+    """
+    Save the map's thumbnail (and for race/versus maps its mirrored Encore
+    variant) at every scale in every format, decoding PICTURE only once.
+    """
+    output_stem = os.path.join(output_location, 'maps', true_name.replace(" ", "_"))
+    encore_output_stem = output_stem + '_Encore'
+    output_paths = []
+
+    enpal = pal
+    if 'ENCORE' in wad.namelist():
+        encore_colormap = wad.read('ENCORE')[:256]
+        enpal = []
+        for i in encore_colormap:
+            enpal.append(palette[i][0])
+            enpal.append(palette[i][1])
+            enpal.append(palette[i][2])
+
+    data = wad.read('PICTURE')
+    encore = map_type == 'race' or map_type == 'versus'
+
+    imgheader = data[:4].tobytes()
+    if imgheader == b'\x89PNG':
+        doom_image = Image.open(wad.open('PICTURE'))
+        doom_image.load()
+        encore_image = doom_image
+        if encore and enpal is not pal:
+            # Recolor at the source resolution and scale like the normal
+            # thumbnail so both are filtered the same way
+            encore_image = encore_recolor(doom_image, pal, enpal)
+        for scale in scales:
+            suffix = scale_suffix(scale, scales)
+            output_paths += save_formats(doom_image.resize((320 * scale, 200 * scale), Image.BILINEAR), output_stem + suffix, formats)
+            if encore:
+                encore_resized_image = ImageOps.mirror(encore_image.resize((320 * scale, 200 * scale), Image.BILINEAR))
+                output_paths += save_formats(encore_resized_image, encore_output_stem + suffix, formats)
+        return output_paths
+
+    # Decode the Doom image into palette indices once and scale those; the
+    # Encore thumbnail is the same indices under the ENCORE palette, mirrored
+    (width, height, left, top, pixels) = decode_patch(data)
+    doom_image = indexed_image(width, height, pixels, pal)
+
+    for scale in scales:
+        suffix = scale_suffix(scale, scales)
+        resized_image = doom_image.resize((320 * scale, 200 * scale), Image.BILINEAR)
+        output_paths += save_formats(resized_image, output_stem + suffix, formats)
+        if encore:
+            encore_image = resized_image.copy()
+            encore_image.putpalette(enpal)
+            output_paths += save_formats(ImageOps.mirror(encore_image), encore_output_stem + suffix, formats)
+    return output_paths
+
+def playpal_indices(image, pal):
+    """
+    PLAYPAL indices for a PNG PICTURE as a paletted image. Pictures drawn
+    with PLAYPAL keep their indices, other colors are matched to the nearest
+    PLAYPAL entry (exactly for up to 256 colors, by Pillow's quantizer past
+    that).
+    """
+    if image.mode == 'P' and image.getpalette()[:768] == list(pal):
+        return image.copy()
+    palette_image = Image.new('P', (1, 1))
+    palette_image.putpalette(pal)
+    rgb_image = image.convert('RGB')
+    colors = rgb_image.getcolors(256)
+    if colors is None:
+        return rgb_image.quantize(palette=palette_image, dither=Image.NONE)
+    # Few enough colors to give each its own index, then map those onto
+    # PLAYPAL with a lookup table
+    own_image = rgb_image.quantize(colors=len(colors))
+    own = own_image.getpalette()
+    playpal = [tuple(pal[i:i + 3]) for i in range(0, 768, 3)]
+    exact = {}
+    for (i, color) in reversed(list(enumerate(playpal))):
+        exact[color] = i
+    lut = []
+    for i in range(0, len(own), 3):
+        color = tuple(own[i:i + 3])
+        if color not in exact:
+            exact[color] = min(range(256), key=lambda j: sum((a - b) ** 2 for (a, b) in zip(color, playpal[j])))
+        lut.append(exact[color])
+    lut += [0] * (256 - len(lut))
+    indices = Image.frombytes('L', own_image.size, own_image.tobytes()).point(lut)
+    return Image.frombytes('P', indices.size, indices.tobytes())
+
+def encore_recolor(image, pal, enpal):
+    """Apply the ENCORE colormap to a PNG PICTURE by way of its PLAYPAL indices."""
+    encore_image = playpal_indices(image, pal)
+    encore_image.putpalette(enpal)
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        encore_image = encore_image.convert('RGBA')
+        encore_image.putalpha(image.convert('RGBA').getchannel('A'))
+    return encore_image
+
+def open_map_worker(doom_file, palette, pal, output_location, scales, formats):
+    return {'pk3': Pk3File(doom_file, 'r'), 'args': (palette, pal, output_location, scales, formats)}
+
+def extract_map_job(task):
+    # Also hand back the WAD's directory so the parent can cache it
+    (wad_name, directory, true_name, map_type) = task
+    wad = workers.state['pk3'].open_wad(wad_name, directory)
+    output_paths = extract_map(wad, true_name, map_type, *workers.state['args'])
+    return (output_paths, wad.directory())
+
+def open_pack(pk3, palette, pal, output_location, scales, cache=None, jobs=1, formats=('png',)):
+    # Directory tree of the zip archive
+    index = cache.index() if cache else ArchiveIndex(pk3.namelist())
+
+    # Specify the parent directory you want to search within
+    parent_directory = 'maps/'
+
+    wad_list = index.files_under(parent_directory, '.wad')
+    soc_list = index.files_under('soc/')
+
+    levels = {}
+    for soc_name in soc_list:
+        get_level_names(pk3, levels, soc_name, cache)
+    os.makedirs(os.path.join(output_location, "maps"), exist_ok=True)
+
+    # When two WADs resolve to the same title the last one wins, so
+    # only that one is extracted and the output never depends on
+    # which worker finishes first
+    titles = {}
+    for wad_name in wad_list:
+        (true_name, map_type) = get_map_title(wad_name, levels)
+        titles.pop(true_name, None)
+        titles[true_name] = (wad_name, map_type)
+    tasks = [(wad_name, cache.wad_directory(wad_name) if cache else None, true_name, map_type) for (true_name, (wad_name, map_type)) in titles.items()]
+
+    if jobs > 1:
+        with workers.process_pool(jobs, open_map_worker, pk3.filename, palette, pal, output_location, scales, formats) as executor:
+            for (task, (output_paths, directory)) in zip(tasks, executor.map(extract_map_job, tasks)):
+                if cache:
+                    cache.add_wad_directory(task[0], directory)
+                for output_path in output_paths:
+                    print(output_path)
+    else:
+        for (wad_name, directory, true_name, map_type) in tasks:
+            wad = cache.open_wad(wad_name) if cache else pk3.open_wad(wad_name)
+            for output_path in extract_map(wad, true_name, map_type, palette, pal, output_location, scales, formats):
+                print(output_path)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract map thumbnails from a map pack.")
+    parser.add_argument('bios', type=str, help='The bios.pk3 file')
+    parser.add_argument('pack', type=str, help='The map pack (.pk3)')
+    parser.add_argument('output_location', type=str, help='The location to output the extracted images')
+    parser.add_argument('scale', type=scale_list, nargs='?', default=[1], help='Size multiplier, or a comma separated list of them to save every size from one decode, e.g. 1,2,4 (default: 1)')
+    parser.add_argument('-f', '--format', type=format_list, default=['png'], help='Image format, or a comma separated list of them, e.g. png,webp (default: png)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of maps to extract in parallel, 0 for one per CPU (default: 1)')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore and do not update the on-disk archive index cache (default: False)')
+    args = parser.parse_args()
+
+    bios_arg = args.bios
+    doom_file = args.pack
+    output_location = args.output_location
+    scales = args.scale
+    formats = args.format
+    jobs = args.jobs or os.cpu_count()
+    cache_dir = False if args.no_cache else None
 
     with zipfile.ZipFile(bios_arg, 'r') as bios:
         palette = []
@@ -76,156 +209,5 @@ if __name__ == "__main__":
             pal.append(palette[i][1])
             pal.append(palette[i][2])
 
-        with zipfile.ZipFile(doom_file, 'r') as pk3:
-            # Get the list of all files and directories in the zip archive
-            all_entries = pk3.namelist()
-
-            # Specify the parent directory you want to search within
-            parent_directory = 'maps/'
-
-            # Set to collect unique folder names
-            wad_set = set()
-            soc_set = set()
-
-            # Iterate over each file and directory in the zip archive
-            for entry in all_entries:
-                # print(entry)
-                # Check if the entry is a directory within the specified parent directory
-                if entry.startswith(parent_directory) and entry.endswith('.wad'):
-                    wad_set.add(entry)
-                if entry.startswith('soc/'):
-                    soc_set.add(entry)
-
-            # Convert the set of folder names to a list
-            wad_list = list(wad_set)
-            soc_list = list(soc_set)
-            # print(wad_list)
-
-            levels = {}
-            for soc_name in soc_list:
-                levels = get_level_names(pk3, levels, soc_name)
-            os.makedirs(os.path.join(output_location, "maps"), exist_ok=True)
-
-            # Print the list of folder names
-            for wad_name in wad_list:
-                # if wad_name == "maps/race/RR_CoastalTemple.wad":
-                #     continue
-                true_name = Path(wad_name).stem
-                map_type = ""
-                # print(true_name)
-                if true_name.lower() in levels:
-                    level = levels[true_name.lower()]
-                    if 'zonetitle' in level:
-                        true_name = '%s %s' % (level['levelname'], level['zonetitle'])
-                    elif 'nozone' in level and level['nozone'] == 'True':
-                        true_name = level['levelname']
-                    else:
-                        true_name = '%s Zone' % (level['levelname'])
-                    if 'act' in level:
-                        true_name += ' %s' % (level['act'])
-                    elif 'menutitle' in level:
-                        true_name += ' %s' % (level['menutitle'])
-
-                    if 'typeoflevel' in level:
-                        map_type = level['typeoflevel'].lower()
-                output_path = os.path.join(output_location, 'maps', true_name.replace(" ", "_") + '.png')
-                encore_output_path = os.path.join(output_location, 'maps', true_name.replace(" ", "_") + '_Encore.png')
-                # if os.path.isfile(output_path):
-                #     output_path = os.path.join(output_location, Path(wad_name).stem + '.png')
-                # _name = extract_name(pk3, folder_name).lower()
-                # folder_path = os.path.join(output_location, "s", character_name.lower())
-                # os.makedirs(folder_path, exist_ok=True)
-                # print(wad_name)
-                wad = WadFile(pk3.open(wad_name, 'r'))
-
-                all_entries = wad.namelist()
-
-                enpal = pal
-                encore_colormap = list()
-                for entry in all_entries:
-                    if entry == 'ENCORE':
-                        enpalette = []
-                        en = wad.open('ENCORE')
-                        encore_colormap = en.read(256)
-                        # for i in range(256):
-                        #     r = en.read(1)
-                        #     g = en.read(1)
-                        #     b = en.read(1)
-                        #     enpalette.append([r, g, b])
-                        colormap = list(range(256))
-                        # print("Colormap")
-                        # print(colormap)
-                        # print("Encore Colormap")
-                        # print(encore_colormap)
-                        enpal = []
-                        for i in encore_colormap:
-                            enpal.append(palette[i][0])
-                            enpal.append(palette[i][1])
-                            enpal.append(palette[i][2])
-
-                # print("Palette")
-                # print(pal)
-                # print("Encore Palette")
-                # print(enpal)
-                # print(encore_colormap)
-                f = wad.open('PICTURE')
-                # print(file)
-                # print(wad_name)
-                # print(data.hex())
-
-                # Read width, height, left, and top from the Doom image
-                # width = int.from_bytes(f.read(2), byteorder='little')
-                # height = int.from_bytes(f.read(2), byteorder='little')
-                imgheader = f.read(4)
-                if imgheader == b'\x89PNG':
-                    doom_image = Image.open(io.BytesIO(imgheader + f.read()))
-                    resized_image = doom_image.resize((320 * scale, 200 * scale), Image.BILINEAR)
-                    resized_image.save(output_path)
-                    if map_type == 'race' or map_type == 'versus':
-                        encore_resized_image = ImageOps.mirror(resized_image)
-                        encore_resized_image.save(encore_output_path)
-                    continue
-                else:
-                    [width, height] = struct.unpack('<HH', imgheader)
-                left = int.from_bytes(f.read(2), byteorder='little')
-                top = int.from_bytes(f.read(2), byteorder='little')
-
-                # Create column_array with width number of elements
-                column_array = [0] * width
-
-                # Read column_array from the Doom image
-                for i in range(width):
-                    column_array[i] = int.from_bytes(f.read(4), byteorder='little')
-
-                # Create a new image with 8-bit pixel format and Doom palette
-                doom_image = Image.new('P', (width, height))
-                doom_image.putpalette(pal)
-                if map_type == 'race' or map_type == 'versus':
-                    encore_image = Image.new('P', (width, height))
-                    encore_image.putpalette(enpal)
-
-                # Read pixels from the Doom image and write to the PNG image
-                for i in range(width):
-                    f.seek(column_array[i])
-                    rowstart = 0
-                    while rowstart != 255:
-                        rowstart = int.from_bytes(f.read(1), byteorder='little')
-                        if rowstart == 255:
-                            break
-                        pixel_count = int.from_bytes(f.read(1), byteorder='little')
-                        dummy_value = int.from_bytes(f.read(1), byteorder='little')
-                        for j in range(pixel_count):
-                            pixel = int.from_bytes(f.read(1), byteorder='little')
-                            doom_image.putpixel((i, j + rowstart), pixel)
-                            if map_type == 'race' or map_type == 'versus':
-                                encore_image.putpixel((i, j + rowstart), pixel)
-                        dummy_value = int.from_bytes(f.read(1), byteorder='little')
-
-                # Save the PNG image
-                resized_image = doom_image.resize((320 * scale, 200 * scale), Image.BILINEAR)
-                resized_image.save(output_path)
-                print(output_path)
-                if map_type == 'race' or map_type == 'versus':
-                    encore_resized_image = ImageOps.mirror(encore_image.resize((320 * scale, 200 * scale), Image.BILINEAR))
-                    encore_resized_image.save(encore_output_path)
-                    print(encore_output_path)
+        with Pk3File(doom_file, 'r') as pk3, IndexCache(pk3, doom_file, cache_dir) as cache:
+            open_pack(pk3, palette, pal, output_location, scales, cache, jobs, formats)
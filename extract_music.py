@@ -10,509 +10,82 @@ import struct
 import json
 import shutil
 import signal
+import tempfile
+import threading
+import functools
+import posixpath
+import time
+import contextlib
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from glob import glob
 from pathlib import Path
+try:
+    import resource
+except ImportError:
+    resource = None
+from archive import Pk3File, WadFile, ArchiveIndex, IndexCache, lump_hash
+from audio_probe import MODULE_FORMATS, SNIFF_SIZE, probe_file, read_wav_header, sniff
+from ogg import retag_vorbis
+from soc import read_soc
 
 forbidden_chars = r'[<>:"/\\|?*]'
 linux_forbidden_chars = r'[/?\0~]'
 replacement_char = '_'
 encore_sample_rate_multiplier = 0.86471
+stream_chunk_size = 1024 * 1024
+
+album_catalog_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'album_catalog.json')
+
+class TrackCatalog(object):
+    """
+    Disc and track numbers of one album, looked up by (name, source). An
+    entry with an empty source matches any addon; otherwise the addon path
+    has to end with it. When several entries match, the earliest wins.
+    """
+    def __init__(self, discs, album=None):
+        self.album = album
+        self._tracks = {}
+        self._sources = []
+        for (i, disc) in enumerate(discs):
+            for (j, entry) in enumerate(disc):
+                if isinstance(entry, str):
+                    entry = {'name': entry, 'source': ''}
+                key = (entry['name'], entry.get('source', ''))
+                self._tracks.setdefault(key, (i+1, j+1))
+                if key[1] not in self._sources:
+                    self._sources.append(key[1])
+
+    def lookup(self, name, addon):
+        found = [self._tracks[(name, source)] for source in self._sources if (name, source) in self._tracks and addon.endswith(source)]
+        if not found:
+            return None
+        (disc, track) = min(found)
+        return {'disc': disc, 'track': track}
+
+def load_catalogs(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return [TrackCatalog(album['discs'], album.get('album')) for album in data['albums']]
+
+@functools.lru_cache(maxsize=None)
+def default_catalogs():
+    return tuple(load_catalogs(album_catalog_path))
 
-album_order = [
-    [ # Disc 1
-        {'name': 'SE_GA_', 'source': ''},
-        {'name': 'Fluvial Beat Deposits', 'source': ''},
-        {'name': 'Open Ocean', 'source': ''},
-        {'name': 'File Select (Reception Mix)', 'source': ''},
-        {'name': 'Cascade Cave Zone, Act 1', 'source': ''},
-        {'name': 'Cascade Cave Zone, Act 2 (Track A)', 'source': ''},
-        {'name': 'Cascade Cave Zone, Act 2 (Track B)', 'source': ''},
-        {'name': 'Across The World', 'source': ''},
-        {'name': 'Back of the Box', 'source': ''},
-        {'name': 'Lost in Recollection', 'source': ''},
-        {'name': 'Live Studio Audience', 'source': ''},
-        {'name': 'Rolling Jump (Arrange)', 'source': ''},
-        {'name': 'Minor Boss (Dual PCM)', 'source': ''},
-        {'name': 'Fluvial Beat Deposits (Invincibility Mix)', 'source': ''},
-        {'name': 'Desert Area (Grow Mix)', 'source': ''},
-        {'name': 'Level Lost', 'source': ''},
-        {'name': 'Level Clear', 'source': ''},
-        {'name': 'Robotnik Clear', 'source': ''},
-        {'name': '[Alternate] Competition Menu', 'source': ''},
-        {'name': 'Race Result', 'source': ''},
-        {'name': 'Knuckles Victory Jingle', 'source': ''},
-        {'name': 'Game Results (Ring Racers Mix)', 'source': ''},
-        {'name': '[Alternate] Credits (Version B)', 'source': ''},
-        {'name': '[Alternate] Credits (Version A)', 'source': ''},
-        {'name': 'Fluvial Beat Deposits (Voting Mix)', 'source': ''},
-        {'name': 'Decision (Track A)', 'source': ''},
-        {'name': 'Decision (Track B)', 'source': ''},
-        {'name': 'CHAO KEY FREE DDL WORKING 2014', 'source': ''},
-        {'name': 'History (Ring Racers Mix)', 'source': ''},
-        {'name': 'Overtime', 'source': ''},
-        {'name': 'Last Stand!', 'source': ''},
-        {'name': 'See Your Sunbeam', 'source': ''},
-        {'name': 'Tidal Chamber', 'source': ''}
-    ],
-    [ # Disc 2
-        {'name': 'Robotnik Coaster', 'source': ''},
-        {'name': 'Broken Moon (Remix)', 'source': ''},
-        {'name': 'Remaining Time', 'source': ''},
-        {'name': 'Splash Wave (Edit)', 'source': ''},
-        {'name': 'Green Hills (SMS)', 'source': ''},
-        {'name': 'Tropic Turf Zone, Act 1', 'source': ''},
-        {'name': 'Special Stage [US]', 'source': ''},
-        {'name': 'Special Stage [JP_PAL]', 'source': ''},
-        {'name': 'UFO Catcher', 'source': ''},
-        {'name': 'All things upon the sine', 'source': ''},
-        {'name': 'Azure Blue World (Edit)', 'source': ''},
-        {'name': 'Windy and Ripply', 'source': ''},
-        {'name': 'Big Fishes at Emerald Coast', 'source': ''},
-        {'name': 'The Core of Distortion', 'source': ''},
-        {'name': 'Lucid Pass Zone', 'source': ''},
-        {'name': 'Sharp Eyes [twilight mix]', 'source': ''},
-        {'name': 'Kronos', 'source': ''},
-        {'name': 'Clockwork Orangeade', 'source': ''},
-        {'name': 'untitled (snon faller)', 'source': ''},
-        {'name': 'Stage 3_ Gratify', 'source': ''},
-        {'name': 'Water Battle IN THE SNOW!', 'source': ''},
-        {'name': 'Estra Nova', 'source': ''},
-        {'name': 'Full-Steam VENGEANCE!!!', 'source': ''},
-        {'name': 'Tower of Heaven -Full moon Revenge- (Edit)', 'source': ''},
-        {'name': 'Platonic Attitude', 'source': ''},
-        {'name': 'Disease Transport (Ring Racers Mix)', 'source': ''},
-        {'name': 'Feverish Transport', 'source': ''},
-        {'name': 'Angel Island (Good Future)', 'source': ''},
-        {'name': 'Angel Island Zone Act 1', 'source': ''},
-        {'name': '[Alternate] Angel Island Zone Act 1', 'source': ''},
-        {'name': 'Instant Death Trap - BOT in the Underground Maze', 'source': ''},
-        {'name': "Akutagawa Ryuunosuke's _Kappa_ _ Candid Friend", 'source': ''},
-        {'name': 'Mirage Saloon Act 1', 'source': ''},
-        {'name': 'Mirage Saloon Act 2', 'source': ''},
-        {'name': 'Mirage Saloon Act 1 (Knuckles)', 'source': ''},
-        {'name': 'Start Fanfare', 'source': ''},
-        {'name': 'Back In Time', 'source': ''},
-        {'name': 'Sanctuary Falls (Back in Time)', 'source': ''},
-        {'name': 'BACK IN TIME ver. CYBERSPACE (Edit)', 'source': ''},
-        {'name': 'Flash Train', 'source': ''},
-        {'name': 'Crystal Lake', 'source': ''},
-        {'name': 'Door Into Summer', 'source': ''},
-        {'name': 'Gigapolis Zone (Ring Racers Mix)', 'source': ''},
-        {'name': 'Thrashard In The Cave (Arrange Ver.)', 'source': ''},
-        {'name': 'The Lake', 'source': ''},
-        {'name': 'Collision Chaos (Present) [JP_PAL]', 'source': ''},
-        {'name': 'Collision Chaos (Present) [US]', 'source': ''},
-        {'name': 'Evening Star', 'source': ''},
-        {'name': 'Emerald Hill Zone', 'source': ''},
-        {'name': 'Emerald Hill Zone 2-Player Mode', 'source': ''},
-        {'name': 'Actions in the Lower World', 'source': ''},
-        {'name': 'Under Construction_ Complete Ver', 'source': ''},
-        {'name': 'Leave it (_Take it!_ Re-Edit)', 'source': ''},
-        {'name': "It's Gonna Happen (Gust Planet Zone Act 1)", 'source': ''},
-        {'name': 'Treacle (Gust Planet Zone Act 3)', 'source': ''},
-        {'name': 'Mystic Cave Zone (YM6212 Rearranged)', 'source': ''},
-        {'name': 'Mystic Cave Zone', 'source': ''},
-        {'name': 'Mystic Cave (Player 2)', 'source': ''},
-        {'name': 'When We Reach For You -Could It Be Right-_ (Track A)',
-         'source': ''},
-        {'name': 'When We Reach For You -Could It Be Right-_ (Track B)',
-         'source': ''},
-        {'name': 'Saturn Start-Up Jingle [JP]', 'source': ''},
-        {'name': 'Opening (US)', 'source': ''},
-        {'name': 'Electoria', 'source': ''},
-        {'name': 'Up And Forward', 'source': ''},
-        {'name': 'Hill Top Zone (Alternate)', 'source': ''},
-        {'name': '[Alternate] Marble Garden Zone Act 1', 'source': ''},
-        {'name': 'Marble Garden Zone Act 2', 'source': ''},
-        {'name': '[Alternate] Marble Garden Zone Act 2', 'source': ''},
-        {'name': 'Fight and Flight (DE Ver.)', 'source': ''},
-        {'name': "Frost Man's Stage (SEGA Genesis Remix)", 'source': ''},
-        {'name': '[Alternate] Launch Base Zone Act 1', 'source': ''},
-        {'name': 'Launch Base Zone Act 1', 'source': ''},
-        {'name': 'Launch Base Zone Act 1 - Remastered', 'source': ''},
-        {'name': 'Mystique Part Three', 'source': ''},
-        {'name': 'With Great Intensity', 'source': ''},
-        {'name': 'Track 10', 'source': ''},
-        {'name': 'Voltage Drop', 'source': ''}
-    ],
-    [ # Disc 3
-        {'name': 'Azure Lake', 'source': ''},
-        {'name': 'Balloon Park', 'source': ''},
-        {'name': 'Chrome Gadget', 'source': ''},
-        {'name': 'Desert Palace', 'source': ''},
-        {'name': 'Endless Mine', 'source': ''},
-        {'name': 'Scorian Cant Zone', 'source': ''},
-        {'name': 'Sprawling Shipyard', 'source': ''},
-        {'name': 'UFO Smasher', 'source': ''},
-        {'name': 'Hi-Spec Robo Go', 'source': ''},
-        {'name': 'Crossing Venom Valley', 'source': ''},
-        {'name': 'Tabloid Jargon', 'source': ''},
-        {'name': 'Gumball Machine (Remix)', 'source': ''},
-        {'name': 'Escape from the City (Arrange) (Track A)', 'source': ''},
-        {'name': 'Escape from the City (Arrange) (Track B)', 'source': ''},
-        {'name': "It Doesn't Matter (Ring Racers Cover)", 'source': ''},
-        {'name': 'Bismuth Chambers', 'source': ''},
-        {'name': "I'm a Spy", 'source': ''},
-        {'name': 'Palmtree Panic (Present) [JP_PAL]', 'source': ''},
-        {'name': 'Palmtree Panic (Present) [US]', 'source': ''},
-        {'name': 'Empyrean Emerald Zone (Present)', 'source': ''},
-        {'name': 'Stage 70 (Arranged)', 'source': ''},
-        {'name': 'Scarlet Rose', 'source': ''},
-        {'name': 'Green Hill Zone Remix', 'source': ''},
-        {'name': 'Star Light Zone (Bad Future)', 'source': ''},
-        {'name': 'Museum', 'source': ''},
-        {'name': 'Track 2', 'source': ''},
-        {'name': 'Mecha Factory', 'source': ''},
-        {'name': 'Metropolis Zone', 'source': 'altmusic.pk3'},
-        {'name': 'Cyan Sunset', 'source': ''},
-        {'name': 'Dark Moon Castle', 'source': ''},
-        {'name': 'Convert', 'source': ''},
-        {'name': 'dream in blue water', 'source': ''},
-        {'name': 'Kartophobia', 'source': ''},
-        {'name': "You've Got to Eat Your Vegetables!!", 'source': ''},
-        {'name': '[Alternate] Hydrocity Zone Act 2', 'source': ''},
-        {'name': 'Hydropolis Act 2', 'source': ''},
-        {'name': 'Hydrocity Zone Act 2', 'source': ''},
-        {'name': 'fruitbat', 'source': ''},
-        {'name': 'Crowded Grove', 'source': ''},
-        {'name': 'Metropolis Zone', 'source': 'music.pk3'},
-        {'name': '_Keep it Moving!__ Trap Tower Remix', 'source': ''},
-        {'name': 'Diamond Dust Zone Act 1 (Genesis)', 'source': ''},
-        {'name': 'Diamond Dust Zone Act 2 (Saturn)', 'source': ''},
-        {'name': 'Tie a Link of ARCUS!', 'source': ''},
-        {'name': 'Tie a Link of ARCUS! (Super Arrange)', 'source': ''},
-        {'name': 'Speed Highway (KB Remix)', 'source': ''},
-        {'name': "Goin' Down!_ (KB Remix)", 'source': ''},
-        {'name': 'Capsaicin Blues', 'source': ''},
-        {'name': 'tuulenvire', 'source': ''},
-        {'name': 'Carnival Night Zone Act 2 - Remastered', 'source': ''},
-        {'name': '[Alternate] Carnival Night Zone Act 2', 'source': ''},
-        {'name': 'Carnival Night Zone Act 1 - Remastered', 'source': ''},
-        {'name': 'Pluto', 'source': ''},
-        {'name': 'Dark Fortress Zone', 'source': ''},
-        {'name': 'Scarab of Glory No. 1', 'source': ''},
-        {'name': 'Spring Yard Zone Act 1', 'source': ''},
-        {'name': 'Labyrinth Soul', 'source': ''},
-        {'name': 'Bust A Move! - Natsuki side -', 'source': ''},
-        {'name': 'Lucky Lounge', 'source': ''},
-        {'name': 'Red Barrage Area', 'source': ''},
-        {'name': 'Bad Taste Aquarium', 'source': ''},
-        {'name': 'Sky Sanctuary Zone (SEGA Genesis Remix)', 'source': ''},
-        {'name': 'Trespasser', 'source': ''},
-        {'name': 'DEATHEGG (Act 1 & 2 Mix)', 'source': ''},
-        {'name': 'Space Trip Steps', 'source': ''},
-        {'name': 'Last Area', 'source': ''},
-        {'name': 'Dew Drop', 'source': ''}
-    ],
-    [ # Disc 4
-        {'name': 'Jibun REST@RT (Edit)', 'source': ''},
-        {'name': 'Exclusive Coupe', 'source': ''},
-        {'name': 'Duel 1 R', 'source': ''},
-        {'name': 'Smart Systems', 'source': ''},
-        {'name': 'Sunset Hill Zone Act 1 (16 bit Remix)', 'source': ''},
-        {'name': "Tails' Lab (Remix)", 'source': ''},
-        {'name': 'Power Plant', 'source': ''},
-        {'name': 'Savannah Citadel (Day)', 'source': ''},
-        {'name': 'With Light Steps', 'source': ''},
-        {'name': 'Searching (Edit)', 'source': ''},
-        {'name': 'Queen of Rose II', 'source': ''},
-        {'name': "Strollin' the City", 'source': ''},
-        {'name': 'Indigo HELiX (Central02)', 'source': ''},
-        {'name': 'Special Stage [Perfect Mix]', 'source': ''},
-        {'name': 'YO-KAI Disco (Meikai Arrange Version)', 'source': ''},
-        {'name': 'Aurora Atoll Zone (Ring Racers Mix)', 'source': ''},
-        {'name': "Let's Go Away (Daytona International Speedway) (Edit)",
-         'source': ''},
-        {'name': 'Turquoise Hill Zone (YM2612 + SN76489 Arrange)', 'source': ''},
-        {'name': "Shawn's Got The Shotgun", 'source': ''},
-        {'name': "At Doom's Gate", 'source': ''},
-        {'name': 'home stay', 'source': ''},
-        {'name': 'Dungeon 1 (v2)', 'source': ''},
-        {'name': 'Edenic Green Plus', 'source': ''},
-        {'name': 'Ice Paradise Act 1 (Remastered)', 'source': ''},
-        {'name': 'Network Transfer', 'source': ''},
-        {'name': 'The Fate of the Fairies (Arrangement)', 'source': ''},
-        {'name': 'SUBURB - Armored Green (Stage2)', 'source': ''},
-        {'name': 'Chao Garden (Dark)', 'source': ''},
-        {'name': 'Chao Garden (Hero)', 'source': ''},
-        {'name': 'Move Out, Dust Chute Transformation Goraigo Mobilize!',
-         'source': ''},
-        {'name': 'Continuation of the Dream (Yume no Tsuzuki)', 'source': ''},
-        {'name': 'Canyon Ride Act 2', 'source': ''},
-        {'name': 'Gust of Wind', 'source': ''},
-        {'name': 'Ice Brain (YM2612 Cover)', 'source': ''},
-        {'name': 'Phantom Razor (Cytus II Edit)', 'source': ''},
-        {'name': 'Ocean Rain', 'source': ''},
-        {'name': 'Mazy Metroplex', 'source': ''},
-        {'name': 'Green Hill Zone [8-bit]', 'source': ''},
-        {'name': 'Bridge Zone Classic (Remix)', 'source': ''},
-        {'name': 'Lava Reef Act 1 (1994 Album Remake)', 'source': ''},
-        {'name': 'Lava Reef Zone (16-Bit)', 'source': ''},
-        {'name': '_Frozen Paradise_ - Ice Cap Zone Act 1 Remix', 'source': ''},
-        {'name': '_MEGA_ Scrap Brain Zone (Remix)', 'source': ''},
-        {'name': 'Emerald Beach (Cover)', 'source': ''},
-        {'name': 'Atlantic Criminal _ Labyrinth Zone (Remix)', 'source': ''},
-        {'name': 'Special Stage - 80s Cover', 'source': ''},
-        {'name': 'Special Stage (Sonic 3 & Knuckles Mix)', 'source': ''},
-        {'name': 'Dimension Heist (Remix)', 'source': ''},
-        {'name': 'Dimension Heist', 'source': ''},
-        {'name': 'Rock the Blue Sphere!', 'source': ''}
-    ],
-    [ # Disc 5
-        {'name': 'Lotus (Arrangement)', 'source': ''},
-        {'name': 'Blood Drain -Again-', 'source': ''},
-        {'name': 'Right There, Ride On (Edit)', 'source': ''},
-        {'name': "Tyr's Stage (Fully Armored)", 'source': ''},
-        {'name': 'Endless Mine Zone Act 2', 'source': ''},
-        {'name': 'seen an angel', 'source': ''},
-        {'name': 'Toy Kingdom Act 1 (Remastered)', 'source': ''},
-        {'name': 'Killing Moon (Arranged)', 'source': ''},
-        {'name': 'Quartz Quadrant Zone (Present) [JP _ PAL]', 'source': ''},
-        {'name': 'Quartz Quadrant Zone (Present) [US]', 'source': ''},
-        {'name': 'Aqua Tunnel 1', 'source': ''},
-        {'name': 'Aqua Tunnel 2', 'source': ''},
-        {'name': 'Back 2 Back', 'source': ''},
-        {'name': 'Final Fall Act 2 (Unused)', 'source': ''},
-        {'name': 'Blood Pain II', 'source': ''},
-        {'name': 'Battle B2 (Boss Battle Theme)', 'source': ''},
-        {'name': 'Haunted Ship (Act 1 & 2 Mix) Remastered', 'source': ''},
-        {'name': 'Robotnik Winter Act 2', 'source': ''},
-        {'name': 'Sewage Base Act 1', 'source': ''},
-        {'name': 'gara[g]e', 'source': ''},
-        {'name': 'Desert Area', 'source': ''},
-        {'name': 'Blizzard Peaks Act 1', 'source': ''},
-        {'name': 'The Crowd Goes Home', 'source': ''},
-        {'name': 'ESP Overload', 'source': ''},
-        {'name': 'Justice OR Voice (Instrumental)', 'source': ''},
-        {'name': 'Cloaca Maxima', 'source': ''},
-        {'name': "Satan's Theme", 'source': ''},
-        {'name': 'Game Planet Starlight', 'source': ''},
-        {'name': 'Monkey Mall', 'source': ''},
-        {'name': 'Night Drips on Banana Leaves', 'source': ''},
-        {'name': 'Game of Blades', 'source': ''},
-        {'name': 'Gambling Turntable', 'source': ''},
-        {'name': 'Sophisticated Fight', 'source': ''},
-        {'name': 'The Praise (God In His Hand)', 'source': ''},
-        {'name': 'Underground Hug', 'source': ''},
-        {'name': "Agonizer's Return", 'source': ''},
-        {'name': 'Massive X', 'source': ''},
-        {'name': 'Neon Nights (LIGHTS UP EVOLUTION MIX) (Track A)', 'source': ''},
-        {'name': 'Neon Nights (LIGHTS UP EVOLUTION MIX) (Track B)', 'source': ''},
-        {'name': 'The Flutter VS The Gesellschaft', 'source': ''},
-        {'name': 'ANCIENT CLOUDS', 'source': ''},
-        {'name': 'Collision Chaos (Good Future) [JP_PAL]', 'source': ''},
-        {'name': 'Collision Chaos (Good Future) [US]', 'source': ''},
-        {'name': '_MEGA_ Star Light Zone (Remix)', 'source': ''},
-        {'name': '_MEGA_ Sandopolis Zone (Remix)', 'source': ''},
-        {'name': 'Aqua Lake (_Saturn_ Remix)', 'source': ''},
-        {'name': 'Flying Battery Zone (8-bit version)', 'source': ''},
-        {'name': "Marble Zone '12", 'source': ''},
-        {'name': 'Sky Babylon (Act 1 & 2 Mix)', 'source': ''},
-        {'name': 'Shooting Star', 'source': ''},
-        {'name': 'Exotic AMATSU', 'source': ''},
-        {'name': 'Stage 6', 'source': ''},
-        {'name': 'Tsuihashi', 'source': ''},
-        {'name': 'What U Need', 'source': ''},
-        {'name': 'Vertigo (Stage 5)', 'source': ''},
-        {'name': 'Anatat Tatanatat', 'source': ''}
-    ],
-    [ # Disc 6
-        {'name': 'Midnight Freeze Zone', 'source': ''},
-        {'name': "Hol Horse's Theme", 'source': ''},
-        {'name': 'AINT NOTHING LIKE A FUNKY BEAT', 'source': ''},
-        {'name': 'Snowboard Race', 'source': ''},
-        {'name': 'End This Hate', 'source': ''},
-        {'name': 'Meadow Match Zone', 'source': ''},
-        {'name': "Mega Man X_ Armored Armadillo's Stage (Arranged)", 'source': ''},
-        {'name': 'DN Bass (Track 11)', 'source': ''},
-        {'name': 'Blizzard Peaks (Act 1 & 2 Mix)', 'source': ''},
-        {'name': '[Alternate] Launch Base Zone Act 2', 'source': ''},
-        {'name': "Al's Toy Barn", 'source': ''},
-        {'name': "Khan's Theme", 'source': ''},
-        {'name': "Zena-Lan's Stage (Fully Armored)", 'source': ''},
-        {'name': 'Aqualung Zone (Ring Racers Mix)', 'source': ''},
-        {'name': 'Menu Theme', 'source': ''},
-        {'name': 'WRONG GAME_ WRONG GAME!', 'source': ''},
-        {'name': 'Phantom Ruby Ambience', 'source': ''},
-        {'name': 'A Journey in Modulating Time (Track A)', 'source': ''},
-        {'name': 'A Journey in Modulating Time (Track B)', 'source': ''},
-        {'name': 'Back Alley Clash', 'source': ''},
-        {'name': 'Loser Club', 'source': ''},
-        {'name': 'Qualified, Set, GO!', 'source': ''},
-        {'name': 'worldsbe.st', 'source': ''},
-        {'name': 'Hidden Palace Zone (Ring Racers Mix)', 'source': ''},
-        {'name': 'Whisk Assessment', 'source': ''},
-        {'name': 'Get That Guy Outta Here', 'source': ''},
-        {'name': 'The Lacustrine Beat Machine', 'source': ''},
-        {'name': 'Out Of Reach', 'source': ''},
-        {'name': 'Retire', 'source': ''},
-        {'name': 'Continue', 'source': ''}
-    ]
-]
-
-srb2kart = [
-    ["Main_Theme",
-    "Staff_Attack_&_Battle_Intermission",
-    "Green_Hills_Zone",
-    "Dark_Race",
-    "Northern_District_Zone",
-    "Darkvile_Garden_Zone",
-    "Dayonta_Speedway_Zone",
-    "Egg_Zeppelin_Zone",
-    "Sonic_Speedway_Zone",
-    "Hill_Top_Zone",
-    "Misty_Maze_Zone",
-    "Grand_Metropolis",
-    "Sunbeam_Paradise_Zone",
-    "Diamond_Square_Zone",
-    "Midnight_Meadow_Zone",
-    "Twinkle_Cart",
-    "Pleasure_Castle",
-    "Paradise_Hill_Zone",
-    "Sub-Zero_Peak_Zone",
-    "Sapphire_Coast_Zone",
-    "Sand_Valley_Zone",
-    "Megablock_Castle_Zone",
-    "Canyon_Rush_Zone",
-    "Casino_Resort_Zone",
-    "Silvercloud_Island_Zone",
-    "Blue_Mountain_Zone",
-    "Petroleum_Refinery_Zone",
-    "Desert_Palace_Zone",
-    "Aurora_Atoll_Zone",
-    "Barren_Badlands_Zone",
-    "Red_Barrage_Area",
-    "Midnight_Channel",
-    "Vanilla_Hotel_Zone",
-    "Toxic_Palace_Zone",
-    "Ancient_Tomb_Zone",
-    "Cloud_Cradle_Zone,_Act_K",
-    "Volcanic_Valley_Zone",
-    "Kodachrome_Void_Zone",
-    "Boiling_Bedrock_Zone",
-    "Egg_Quarters",
-    "Virtual_Highway_Zone",
-    "Eggman's_Nightclub_Zone",
-    "KKR_Ganbare_Dochu_2",
-    "CK_Chao_Circuit_1",
-    "CK_Chao_Circuit_2",
-    "CK_Cloud_Tops_2",
-    "CK_Regal_Raceway",
-    "SD2_Balloon_Panic",
-    "SM_Special_Stage_3",
-    "MKSC_Sky_Garden",
-    "MKDS_Peach_Gardens",
-    "MKSC_Rainbow_Road",
-    "SMK_Donut_Plains_1",
-    "SMK_Mario_Circuit_2",
-    "SMK_Ghost_Valley_2",
-    "SMK_Bowser_Castle_3",
-    "SMK_Vanilla_Lake_2",
-    "Lake_Margorite_Zone",
-    "Coastal_Temple_Zone",
-    "Kart_Airlines_Zone",
-    "Opulence_Zone",
-    "Crimson_Core_Zone"],
-    ["Municipal_Meadow_Zone",
-    "Tricircle_Marina_Zone",
-    "Tinkerer's_Arena_Zone",
-    "Clucky_Farms_Zone",
-    "Techno_Hill_Zone",
-    "Marble_Zone",
-    "Colosseum",
-    "Dried_Battledune_Zone",
-    "Eerie_Grove_Zone",
-    "Rusty_Rig_Zone",
-    "Fantastic_Tabernacle_Zone",
-    "Bad_Taste_Aquarium",
-    "Spotlight_Syndicate_Zone",
-    "City_Skyline_Zone",
-    "Fakery_Way",
-    "Bumper_Carts",
-    "Death_Egg's_Eye",
-    "Power_Plant",
-    "Tails'_Lab",
-    "Armored_Armadillo",
-    "Trigger_Happy_Havoc",
-    "Mementos",
-    "CD_Special_Stage_1",
-    "SMK_Battle_Course_1,_2,_&_4",
-    "SMK_Battle_Course_3",
-    "MK64_Block_Fort_&_Double_Deck",
-    "Crystal_Abyss_Zone",
-    "Peach's_Castle",
-    "Arid_Sands",
-    "Chemical_Facility_Zone",
-    "3_Color_Drive_Zone",
-    "CK_Cloud_Tops_1",
-    "CK_Dungeon_Maze",
-    "Diamond_Square_Classic",
-    "PWR_Retro_Maze",
-    "SRB2_Frozen_Night_Zone",
-    "FZ_Silence",
-    "SMK_Rainbow_Road",
-    "SRB2_Meadow_Match_Zone",
-    "battal_BOWL_Match",
-    "Blue_Mountain_Classic",
-    "Black_Bliss_Zone"],
-    ["Voting",
-    "Voting_(Roulette)",
-    "Voting_(Roulette_End)",
-    "Invincibility",
-    "Grow",
-    "Starting_Countdown",
-    "Starting_Countdown_(Encore)",
-    "Race_Finish_(Win)",
-    "Race_Finish_(Cool)",
-    "Race_Finish_(Lose)",
-    "Race_Finish_(NO_CONTEST)",
-    "Battle_Finish_(Win)",
-    "Battle_Finish_(Cool)",
-    "Battle_Finish_(Lose)",
-    "Waiting_To_Join",
-    "Challenger_Joins",
-    "Credits",
-    "Replay_Hut"]
-]
-
-
-class WadFile(object):
-    def __init__(self, source=None, filename=None):
-        self._files = {}
-        if not source:
-            source = open(filename, 'rb')
-        self._source = source
-        header = source.read(12)
-        (magic, numFiles, dirOffset) = struct.unpack('<III', header)
-        source.seek(dirOffset)
-        for i in range(numFiles):
-            dirent = source.read(16)
-            (pos, size, name) = struct.unpack('<II8s', dirent)
-            name = name.replace(b'\0', b'').decode()
-            self._files[name] = { "pos": pos, "size": size }
-
-    def namelist(self):
-        return self._files.keys()
-    
-    def open(self, name, mode='r'):
-        dirent = self._files[name]
-        self._source.seek(dirent['pos'])
-        return io.BytesIO(self._source.read(dirent['size']))
 
 def signal_handler(sig, frame):
     print('\nCancelled')
     # Perform any cleanup here
     sys.exit(0)
 
-def get_track_number(file_name):
-    for i in range(0, len(album_order)):
-        for j in range(0, len(album_order[i])):
-            if album_order[i][j]['name'] == file_name and addon.endswith(album_order[i][j]['source']):
-                return {'disc': i+1, 'track': j+1}
-    for i in range(0, len(srb2kart)):
-        for j in range(0, len(srb2kart[i])):
-            if srb2kart[i][j] == file_name:
-                return {'disc': i+1, 'track': j+1}
+def get_track_number(file_name, addon, catalogs=()):
+    """
+    Return the disc and track number of a song from the bundled album
+    catalogs, then from any extra catalogs the caller passes in.
+    """
+    for catalog in default_catalogs() + tuple(catalogs):
+        order = catalog.lookup(file_name, addon)
+        if order:
+            return order
     return None
 
 
@@ -530,59 +103,14 @@ def sanitize_filename(filename):
     
     return sanitized_name
 
-def get_file_extension(binary_data):
-    # File signatures (magic numbers) and their corresponding file extensions
-    magic_numbers = {
-        b'IMPM': 'it',  # IT (Impulse Tracker) at offset 0
-        b'Extended Module: ': 'xm',  # XM (FastTracker 2 Extended Module) at offset 0
-        b'SCRM': 's3m',  # S3M (ScreamTracker 3 Module) at offset 44
-        # MOD files have various formats
-        b'M.K.': 'mod',  # Protracker at offset 1080
-        b'M!K!': 'mod',
-        b'4CHN': 'mod',
-        b'6CHN': 'mod',
-        b'8CHN': 'mod',
-        b'OggS': 'ogg',
-    }
+def get_route(format):
+    # vgmstream-cli can't decode tracker modules, ffmpeg (libopenmpt) can
+    if format in MODULE_FORMATS:
+        return "ffmpeg"
+    return "vgmstream"
 
-    for signature, extension in magic_numbers.items():
-        if binary_data.startswith(signature):
-            return extension
-
-    return 's3m'  # default to 'bin' if unknown
-
-def number_to_letter(n):
-    if 0 <= n < 26:
-        return chr(ord('A') + n)
-    else:
-        return None
-
-def get_level_names(pk3, levels, soc):
-    currentLevel = None
-    with pk3.open(soc) as file:
-        # Read the entire file content as bytes
-        file_content_bytes = file.read()
-        # Decode bytes to string using UTF-8 encoding (or appropriate encoding for your file)
-        file_content = file_content_bytes.decode('utf-8')
-        for line in file_content.splitlines():
-            # print(line)
-            # print(line, line.startswith('Level'), line.startswith('#'), '=' in line)
-            if line.startswith('Lump '):
-                currentLevel = line.split(' ')[1].lower().replace('\\', '').split(",")
-                # currentLevel = line.replace('=', ' ').strip().split(' ')[-1]
-                i = 0
-                for level in currentLevel:
-                    levels[level] = {}
-                    if len(currentLevel) > 1:
-                        levels[level]["track"] = number_to_letter(i)
-                    i = i + 1
-                continue
-            elif not currentLevel or line.startswith('#') or '=' not in line:
-                continue
-            for level in currentLevel:
-                [key, value] = line.split('=', 1)
-                levels[level][key.strip().lower()] = value.strip()
-            # print(currentLevel)
+def get_level_names(pk3, levels, soc, cache=None):
+    levels.update(read_soc(pk3, soc, cache)["lumps"])
     return levels
 
 def valid_positive_int(value):
@@ -591,223 +119,723 @@ def valid_positive_int(value):
         raise argparse.ArgumentTypeError(f"Invalid value: {value}. The value must be an integer greater than or equal to 1.")
     return ivalue
 
-def extract_music(pk3, args):
-    addon = args.addon
+def valid_positive_int_list(value):
+    values = []
+    for item in value.split(','):
+        item = valid_positive_int(item)
+        if item not in values:
+            values.append(item)
+    return values
+
+def get_variants(args):
+    """
+    Every combination of output file type, tuning and loop count asked for.
+    With a single variant the songs go straight into output_location as
+    before, otherwise each variant gets a subdirectory named after the
+    options that differ, e.g. mp3-encore or ogg-loop2.
+    """
+    file_types = []
+    for file_type in args.file_type.split(','):
+        file_type = "." + file_type.strip().lstrip('.')
+        if file_type not in file_types:
+            file_types.append(file_type)
+    tunings = [False, True] if args.with_encore else [args.encore]
+    loop_counts = args.loop_count
+    variants = []
+    for file_type in file_types:
+        for encore in tunings:
+            for loop_count in loop_counts:
+                parts = []
+                if len(file_types) > 1:
+                    parts.append(file_type[1:])
+                if len(tunings) > 1:
+                    parts.append("encore" if encore else "normal")
+                if len(loop_counts) > 1:
+                    parts.append(f'loop{loop_count}')
+                variants.append({
+                    "file_type": file_type,
+                    "encore": encore,
+                    "loop_count": loop_count,
+                    "folder": '-'.join(parts),
+                })
+    return variants
+
+class ConversionError(Exception):
+    pass
+
+class Cancelled(Exception):
+    pass
+
+class JobControl(object):
+    """
+    Tracks the external processes started by running jobs so that the first
+    failure (or Ctrl+C) can stop every other job instead of waiting for it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self.cancelled = False
+
+    def _start(self, command, **kwargs):
+        with self._lock:
+            if self.cancelled:
+                raise Cancelled()
+            process = subprocess.Popen(command, **kwargs)
+            self._processes.add(process)
+        return process
+
+    def _wait(self, process, usage=None):
+        """
+        Wait for process and, where the OS reports it, add the CPU seconds it
+        used to usage[program name].
+        """
+        if usage is not None and hasattr(os, 'wait4') and process.returncode is None:
+            try:
+                (pid, status, rusage) = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                name = os.path.basename(process.args[0])
+                usage[name] = usage.get(name, 0) + rusage.ru_utime + rusage.ru_stime
+                return
+            except ChildProcessError:
+                pass
+        process.wait()
+
+    def _finish(self, process):
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        with self._lock:
+            self._processes.discard(process)
+
+    def run(self, command, check=False, capture=False, usage=None):
+        stdout = subprocess.PIPE if capture else subprocess.DEVNULL
+        process = self._start(command, stdout=stdout, stderr=subprocess.DEVNULL, text=capture)
+        try:
+            stdout = process.stdout.read() if capture else None
+            stderr = None
+            self._wait(process, usage)
+        finally:
+            self._finish(process)
+        if self.cancelled:
+            raise Cancelled()
+        if check and process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+        return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+    def stream(self, decode, encode, usage=None):
+        """
+        Pipe the WAV written to stdout by the decode command into the stdin of
+        the command returned by encode(sample_rate), so no PCM touches disk.
+        Either command failing raises CalledProcessError like run(check=True)
+        does.
+        """
+        decoder = self._start(decode, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        encoder = None
+        try:
+            try:
+                (header, info) = read_wav_header(decoder.stdout)
+            except ValueError:
+                self._wait(decoder, usage)
+                if self.cancelled:
+                    raise Cancelled()
+                raise subprocess.CalledProcessError(decoder.returncode or 1, decode)
+            command = encode(info['sample_rate'])
+            encoder = self._start(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                encoder.stdin.write(header)
+                shutil.copyfileobj(decoder.stdout, encoder.stdin, stream_chunk_size)
+                encoder.stdin.close()
+            except BrokenPipeError:
+                # The encoder gave up; its exit status says why. Stop reading
+                # so the decoder isn't left blocked writing to a full pipe
+                decoder.stdout.close()
+            self._wait(decoder, usage)
+            self._wait(encoder, usage)
+        finally:
+            self._finish(decoder)
+            if encoder:
+                self._finish(encoder)
+        if self.cancelled:
+            raise Cancelled()
+        if encoder.returncode:
+            raise subprocess.CalledProcessError(encoder.returncode, command)
+        if decoder.returncode:
+            raise subprocess.CalledProcessError(decoder.returncode, decode)
+        return subprocess.CompletedProcess(command, encoder.returncode)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                process.terminate()
+
+class Manifest(object):
+    """
+    Record, kept in the output directory, of the source lump, MUSICDEF entry
+    and options that produced each output file. Entries are written as each
+    song finishes, so a rerun (or a resumed, interrupted run) only redoes
+    songs that are missing or whose inputs changed.
+    """
+    file_name = '.extract_music.json'
+
+    def __init__(self, output_location):
+        self._output_location = output_location
+        self._path = os.path.join(output_location, self.file_name)
+        self._lock = threading.Lock()
+        self._songs = {}
+        try:
+            with open(self._path, 'r') as f:
+                self._songs = json.load(f)["songs"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _key(self, song_name):
+        return os.path.relpath(song_name, self._output_location)
+
+    def is_current(self, song_name, record):
+        with self._lock:
+            entry = self._songs.get(self._key(song_name))
+        return entry == record and os.path.isfile(song_name)
+
+    def update(self, song_name, record):
+        with self._lock:
+            self._songs[self._key(song_name)] = record
+            tmp = self._path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({"songs": self._songs}, f, indent=4)
+            os.replace(tmp, self._path)
+
+class SongStats(object):
+    def __init__(self, source):
+        self.source = source
+        self.outputs = []
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the body as one stage. The body fills in bytes_in/bytes_out and
+        passes record["processes"] on to JobControl so the CPU time of the
+        programs it runs is counted as well as this thread's.
+        """
+        record = {"stage": name, "wall": 0, "cpu": 0, "bytes_in": 0, "bytes_out": 0, "processes": {}}
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.thread_time() - cpu + sum(record["processes"].values())
+            self.stages.append(record)
+
+    def report(self):
+        return {
+            "source": self.source,
+            "outputs": self.outputs,
+            "wall": sum(stage["wall"] for stage in self.stages),
+            "cpu": sum(stage["cpu"] for stage in self.stages),
+            "bytes_in": sum(stage["bytes_in"] for stage in self.stages if stage["stage"] == "extract"),
+            "bytes_out": sum(stage["bytes_out"] for stage in self.stages if stage["stage"] in ("stream", "ffmpeg", "passthrough")),
+            "stages": self.stages,
+        }
+
+class Stats(object):
+    """
+    Wall time, CPU time and bytes in/out of every converted song and each of
+    its stages (extract, passthrough, stream, probe, ffmpeg) for --profile and
+    --stats-json. Process CPU time comes from wait4() and is exact per
+    program; the totals for the whole run use RUSAGE_CHILDREN.
+    """
+    version = 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._songs = []
+        self._wall = time.perf_counter()
+        self._cpu = self._process_cpu()
+        self.setup = None
+
+    def _process_cpu(self):
+        cpu = time.process_time()
+        if resource:
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu += usage.ru_utime + usage.ru_stime
+        return cpu
+
+    def mark_setup(self):
+        self.setup = {"wall": time.perf_counter() - self._wall, "cpu": self._process_cpu() - self._cpu}
+
+    def song(self, source):
+        song = SongStats(source)
+        with self._lock:
+            self._songs.append(song)
+        return song
+
+    def report(self, args, slowest=5):
+        songs = [song.report() for song in self._songs if song.stages]
+        stages = {}
+        for song in songs:
+            for stage in song["stages"]:
+                total = stages.setdefault(stage["stage"], {"count": 0, "wall": 0, "cpu": 0, "bytes_in": 0, "bytes_out": 0})
+                total["count"] += 1
+                for field in ("wall", "cpu", "bytes_in", "bytes_out"):
+                    total[field] += stage[field]
+        return {
+            "version": self.version,
+            "addon": args.addon,
+            "jobs": args.jobs or os.cpu_count(),
+            "wall": time.perf_counter() - self._wall,
+            "cpu": self._process_cpu() - self._cpu,
+            "setup": self.setup,
+            "songs_converted": len(songs),
+            "bytes_in": sum(song["bytes_in"] for song in songs),
+            "bytes_out": sum(song["bytes_out"] for song in songs),
+            "stages": stages,
+            "slowest": [{"source": song["source"], "wall": song["wall"], "cpu": song["cpu"]}
+                        for song in sorted(songs, key=lambda song: song["wall"], reverse=True)[:slowest]],
+            "songs": songs,
+        }
+
+def print_stats(report):
+    print('Profile: \t', f'{report["songs_converted"]} songs in {report["wall"]:.2f}s wall, {report["cpu"]:.2f}s CPU')
+    if report["setup"]:
+        print('  setup', f'{report["setup"]["wall"]:.2f}s wall', f'{report["setup"]["cpu"]:.2f}s CPU')
+    for (name, stage) in report["stages"].items():
+        print(f'  {name:<10}', f'x{stage["count"]:<4}', f'{stage["wall"]:.2f}s wall', f'{stage["cpu"]:.2f}s CPU',
+              f'{stage["bytes_in"]} bytes in', f'{stage["bytes_out"]} bytes out')
+    if report["slowest"]:
+        print('Slowest: \t')
+        for song in report["slowest"]:
+            print(f'  {song["wall"]:.2f}s', song["source"])
+
+def song_record(pk3, job, variant, args):
+    return {
+        "source": job["file"],
+        "source_hash": lump_hash(pk3, job["file"]),
+        "musicdef": job["definition"],
+        "options": {
+            "file_type": variant["file_type"],
+            "encore": variant["encore"],
+            "loop_count": variant["loop_count"],
+            "fade": not args.no_fade,
+            "volume": job["volume"],
+        },
+    }
+
+def get_song_info(key, song, output_location, file_type, original_volume, addon, catalogs=()):
+    song_name = os.path.join(output_location, key + file_type)
+    sanitized_name = key
+    volume = 1
+    title = ""
+    artist = ""
+    album = ""
+    track = ""
+    track_num = ""
+    disc_num = ""
+    order_prefix = ""
+    release_date = ""
+    if "track" in song:
+        track = f' (Track {song["track"]})'
+    if "title" in song:
+        sanitized_name = sanitize_filename(song["title"] + track)
+        order = get_track_number(sanitized_name, addon, catalogs)
+        if not order == None:
+            track_num = order["track"]
+            disc_num = order["disc"]
+            order_prefix = f'{disc_num}-{track_num} '
+        song_name = os.path.join(output_location, order_prefix + sanitized_name + track + file_type)
+        title = song["title"] + track
+        album = 'Dr. Robotnik\'s Ring Racers'
+        release_date = "2024-04-24T05:47:00-05:00"
+    if "usage" in song:
+        sanitized_name = sanitize_filename(song["source"].split('_-_')[0].replace('_', ' '))
+        artist = song["source"].split('_-_')[1].replace('_', ' ')
+        order = get_track_number(song['usage'], addon, catalogs)
+        if not order == None:
+            track_num = order["track"]
+            disc_num = order["disc"]
+            order_prefix = f'{disc_num}-{track_num} '
+        song_name = os.path.join(output_location, order_prefix + sanitized_name + track + file_type)
+        title = song["source"].split('_-_')[0].replace('_', ' ')
+        album = 'SRB2Kart'
+        release_date = "2018"
+    if "volume" in song and not original_volume:
+        volume = int(song["volume"].split(' #')[0])/100.0
+    if "author" in song:
+        artist = song["author"]
+    if "originalcomposers" in song:
+        if not artist == "":
+            artist += ", "
+        artist += song["originalcomposers"]
+    return {
+        "song_name": song_name,
+        "volume": volume,
+        "title": title,
+        "artist": artist,
+        "album": album,
+        "track_num": track_num,
+        "disc_num": disc_num,
+        "release_date": release_date,
+    }
+
+def match_music_lumps(music_list, songs):
+    """
+    Pair every O_ lump with its MUSICDEF entry by looking its name up, with
+    and without the extension, in the (lowercase) MUSICDEF keys. Also
+    returns what was left over or matched more than once so it can be
+    reported instead of silently dropped.
+    """
+    report = {"matches": [], "orphan_lumps": [], "orphan_definitions": [], "ambiguous": {}, "duplicates": {}}
+    lumps_by_key = {}
+    for file in music_list:
+        name = posixpath.basename(file)[len("O_"):].lower()
+        keys = [key for key in dict.fromkeys((name, posixpath.splitext(name)[0])) if key in songs]
+        if not keys:
+            report["orphan_lumps"].append(file)
+            continue
+        if len(keys) > 1:
+            report["ambiguous"][file] = keys
+        report["matches"].append((file, keys[0]))
+        lumps_by_key.setdefault(keys[0], []).append(file)
+    report["orphan_definitions"] = [key for key in songs if key not in lumps_by_key]
+    report["duplicates"] = {key: files for (key, files) in lumps_by_key.items() if len(files) > 1}
+    return report
+
+def print_match_report(report):
+    for file in report["orphan_lumps"]:
+        print('Orphan lump: \t', file)
+    for key in report["orphan_definitions"]:
+        print('Orphan MUSICDEF: \t', key)
+    for (file, keys) in report["ambiguous"].items():
+        print('Ambiguous lump: \t', file, '=>', ', '.join(keys))
+    for (key, files) in report["duplicates"].items():
+        print('Duplicate lumps: \t', key, '<=', ', '.join(files))
+
+def plan_music(pk3, matches, songs, variants, args):
     output_location = args.output_location
-    encore_mode = args.encore
-    no_fade = args.no_fade
     original_volume = args.original_volume
-    file_type = args.file_type if args.file_type.startswith('.') else "." + args.file_type
-    loop_count = args.loop_count
+    catalogs = [catalog for path in args.catalog for catalog in load_catalogs(path)]
+
+    jobs = []
+    for (file, key) in matches:
+        (fname, fext) = posixpath.splitext(file)
+        with pk3.open(file) as song:
+            format = sniff(song.read(SNIFF_SIZE))
+        # Trust the lump's contents over its name, the decoders go by extension
+        if format:
+            fext = "." + format
+        elif not fext:
+            fext = ".bin"
+        job = get_song_info(key, songs[key], '', '', original_volume, args.addon, catalogs)
+        stem = job.pop("song_name")
+        outputs = [{
+            "variant": variant,
+            "song_name": os.path.join(output_location, variant["folder"], stem + variant["file_type"]),
+        } for variant in variants]
+        job.update({"file": file, "source": fname+fext, "fext": fext, "key": key, "outputs": outputs,
+                    "format": format, "route": get_route(format)})
+        jobs.append(job)
+    return jobs
+
+def encode_command(input_path, job, sample_rate, outputs):
+    """
+    One ffmpeg invocation writing every output from a single input, each
+    output file with its own tags and filter chain.
+    """
+    command = [
+            "ffmpeg",
+            "-i", input_path,
+            "-y",
+    ]
+    for output in outputs:
+        asetrate = f',asetrate={sample_rate}*{encore_sample_rate_multiplier}' if output["variant"]["encore"] else ''
+        command += [
+            "-metadata", f'title={job["title"]}',
+            "-metadata", f'artist={job["artist"]}',
+            "-metadata", f'track={job["track_num"]}',
+            "-metadata", f'disc={job["disc_num"]}',
+            "-metadata", f'date={job["release_date"]}',
+            "-metadata", f'album_artist=Kart Krew',
+            "-metadata", f'album={job["album"]}',
+            "-filter:a", f'volume={job["volume"]}{asetrate}',
+            "-q:a", "0",
+            output["song_name"]
+        ]
+    return command
+
+def can_pass_through(job, variant, args):
+    # Nothing would change the audio, so re-encoding would only lose quality
+    return (job["format"] == "ogg" and variant["file_type"] == ".ogg" and variant["loop_count"] == 1
+            and args.no_fade and not variant["encore"] and job["volume"] == 1)
+
+def vorbis_tags(job):
+    # The Vorbis comment names ffmpeg writes for encode_command's -metadata
+    return {
+        "TITLE": job["title"],
+        "ARTIST": job["artist"],
+        "TRACKNUMBER": job["track_num"],
+        "DISCNUMBER": job["disc_num"],
+        "DATE": job["release_date"],
+        "ALBUMARTIST": "Kart Krew",
+        "ALBUM": job["album"],
+    }
+
+def probe_command(input_path):
+    return [
+            "ffprobe",
+            "-v", "error",
+            "-select_streams", "a:0",
+            "-show_entries", "stream=sample_rate",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            input_path
+    ]
+
+def convert_song(pk3, job, outputs, args, control, log, stats, done):
+    """
+    Stream vgmstream-cli's decoded PCM straight into ffmpeg for one song,
+    falling back to ffmpeg alone if vgmstream-cli can't decode the lump.
+    Songs routed to ffmpeg (tracker modules) skip vgmstream-cli entirely.
+    vgmstream-cli needs a seekable input, so the lump itself is still
+    written to the song's temporary workspace, but the decoded WAV is not.
+    The song is decoded once per loop count and a single ffmpeg encodes
+    every output wanting that decode. Outputs that would come out the same
+    as an Ogg Vorbis lump are copied from it instead, with only the tags
+    rewritten. done(outputs) is called with the outputs of each step that
+    succeeded.
+    """
+    fade_length = "0" if args.no_fade else "10"
     verbose = args.verbose
-    dry = args.dry_run
+    use_vgmstream = job["route"] == "vgmstream"
 
-    all_entries = pk3.namelist()
+    if verbose:
+        log("Route: \t", job["route"], f'({job["format"] or "unknown format"})')
 
-    musicdef_files = set()
-    music_files = set()
+    workspace = tempfile.mkdtemp(prefix='.tmp-', dir=args.output_location)
+    try:
+        source = os.path.join(workspace, "tmp" + job["fext"])
+        # Copy the lump out a chunk at a time so memory use doesn't grow
+        # with the size of the song
+        with stats.stage("extract") as stage:
+            with pk3.open(job["file"]) as song, open(source, "wb") as output:
+                shutil.copyfileobj(song, output, stream_chunk_size)
+            info = pk3.getinfo(job["file"])
+            stage["bytes_in"] = info.compress_size if isinstance(pk3, zipfile.ZipFile) else info["size"]
+            stage["bytes_out"] = size = os.path.getsize(source)
 
-    
-    for entry in all_entries:
-        if "MUSICDEF" in entry:
-            musicdef_files.add(entry)
-        if Path(entry).name.startswith("O_"):
-            music_files.add(entry)
-    def_list = list(musicdef_files)
-    music_list = list(music_files)
-
-    # file_paths = [
-    #     "Music/Sekhedsu/O_KOVOZ",
-    #     "Music/Tape/O_CACRZ",
-    #     "Music/Tape/O_CHSEZ",
-    #     "Music/Tape/O_WHWAZ",
-    #     "Music/Tape/O_NOSHZ.it",
-    #     "Music/Tape/O_DOPE1.it",
-    #     "Music/Tape/O_CRISZ.mod",
-    #     "Music/Tape/O_MYGAZ",
-    #     "Music/Tape/O_BAFOZ",
-    #     "Music/Tape/O_TIARZ",
-    #     "Music/Tape/O_HOHOZ",
-    #     "Music/Tape/O_HYPLZ",
-    #     "Music/Tape/O_THTOZ",
-    #     "Music/Tape/O_TRMAZ.xm"
-    # ]
+        encode = []
+        for output in outputs:
+            if not can_pass_through(job, output["variant"], args):
+                encode.append(output)
+                continue
+            if verbose:
+                log("Passthrough: \t", output["song_name"])
+            copy = os.path.join(workspace, "passthrough.ogg")
+            try:
+                with stats.stage("passthrough") as stage:
+                    stage["bytes_in"] = size
+                    with open(source, "rb") as input, open(copy, "wb") as destination:
+                        retag_vorbis(input, destination, vorbis_tags(job))
+                    stage["bytes_out"] = os.path.getsize(copy)
+                os.replace(copy, output["song_name"])
+                done([output])
+            except (ValueError, struct.error) as e:
+                log('Warning: ', f'Could not copy the Ogg stream ({e}), re-encoding')
+                encode.append(output)
+
+        decodes = {}
+        for output in encode:
+            # ffmpeg alone doesn't loop, so every output shares one run
+            loop_count = output["variant"]["loop_count"] if use_vgmstream else None
+            decodes.setdefault(loop_count, []).append(output)
+        for (loop_count, group) in decodes.items():
+            if use_vgmstream:
+                command1 = [
+                        "vgmstream-cli",
+                        "-p",
+                        "-l", f'{loop_count}',
+                        "-f", fade_length,
+                        source
+                ]
+                def encoder(sample_rate):
+                    if verbose:
+                        log("Sample Rate: \t", sample_rate)
+                    command3 = encode_command("pipe:0", job, sample_rate, group)
+                    if verbose:
+                        log("Running: \t", ' '.join(command3))
+                    return command3
+                try:
+                    if verbose:
+                        log("Running: \t", ' '.join(command1))
+                    with stats.stage("stream") as stage:
+                        stage["bytes_in"] = size
+                        control.stream(command1, encoder, stage["processes"])
+                        stage["bytes_out"] = output_size(group)
+                    if verbose:
+                        log('done')
+                    done(group)
+                    continue
+                except Cancelled:
+                    raise
+                except Exception as e:
+                    log('Error: ', "Could not convert with vgmstream-cli")
+                    log('Warning: ',"Falling back to ffmpeg")
+            try:
+                with stats.stage("probe") as stage:
+                    stage["bytes_in"] = size
+                    info = probe_file(source)
+                    if info:
+                        sample_rate = info['sample_rate']
+                    else:
+                        command2 = probe_command(source)
+                        if verbose:
+                            log("Running: \t", ' '.join(command2))
+                        result = control.run(command2, capture=True, usage=stage["processes"])
+                        sample_rate = result.stdout.strip()
+                if verbose:
+                    log("Sample Rate: \t", sample_rate)
+                command3 = encode_command(source, job, sample_rate, group)
+                if verbose:
+                    log("Running: \t", ' '.join(command3))
+                with stats.stage("ffmpeg") as stage:
+                    stage["bytes_in"] = size
+                    try:
+                        control.run(command3, check=True, usage=stage["processes"])
+                    finally:
+                        stage["bytes_out"] = output_size(group)
+                if verbose:
+                    log('done')
+                done(group)
+            except Cancelled:
+                raise
+            except Exception:
+                raise ConversionError('Could not convert with ffmpeg')
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+def output_size(outputs):
+    return sum(os.path.getsize(output["song_name"]) for output in outputs if os.path.isfile(output["song_name"]))
+
+def run_job(pk3, job, args, control, manifest, stats, log):
+    if args.verbose:
+        cols = shutil.get_terminal_size().columns
+        log("=" * cols)
+    pending = []
+    for output in job["outputs"]:
+        record = song_record(pk3, job, output["variant"], args)
+        if not args.force and manifest.is_current(output["song_name"], record):
+            log(f'[{job["progress"]}/{job["total"]}]','Unchanged: \t', job["source"], '=>', output["song_name"])
+        else:
+            pending.append((output, record))
+    if not pending:
+        return
+    for (output, record) in pending:
+        log(f'[{job["progress"]}/{job["total"]}]','Converting: \t', job["source"], '=>', output["song_name"])
+    if args.verbose:
+        log(job["key"], json.dumps(job["definition"], indent=4))
+    if args.dry_run:
+        return
+    song_stats = stats.song(job["source"])
+    song_stats.outputs = [output["song_name"] for (output, record) in pending]
+    records = {output["song_name"]: record for (output, record) in pending}
+    def done(outputs):
+        # Only outputs that were written in full are recorded, so a failed
+        # one is retried on the next run
+        for output in outputs:
+            manifest.update(output["song_name"], records[output["song_name"]])
+    convert_song(pk3, job, [output for (output, record) in pending], args, control, log, song_stats, done)
+
+def run_job_buffered(pk3, job, args, control, manifest, stats):
+    lines = []
+    try:
+        # A song still queued when another one failed is not started at all
+        if control.cancelled:
+            raise Cancelled()
+        run_job(pk3, job, args, control, manifest, stats, lambda *line: lines.append(line))
+    except BaseException as e:
+        # Whatever went wrong, the main loop prints what the job had logged
+        e.lines = lines
+        raise
+    return lines
+
+def extract_music(pk3, args, cache=None):
+    output_location = args.output_location
+    jobs = args.jobs or os.cpu_count()
+    stats = Stats()
+
+    index = cache.index() if cache else ArchiveIndex(pk3.namelist())
 
+    def_list = index.basename_prefix("MUSICDEF")
+    music_list = index.basename_prefix("O_")
 
     songs = {}
     for soc_name in def_list:
-        levels = get_level_names(pk3, songs, soc_name)
+        get_level_names(pk3, songs, soc_name, cache)
 
     # print(json.dumps(songs, indent=4))
     # print(music_list)
-    os.makedirs(os.path.join(output_location), exist_ok=True)
-    progress = 1
-    for file in music_list:
-        fparts = file.split('.')
-        fname = fparts[0]
-        fext = ''
-        with pk3.open(file) as song:
-            binary = song.read()
-            if len(fparts) > 1:
-                fext = "." + fparts[1]
-            else:
-                fext = "." + get_file_extension(binary)
-            fname = fname.split('.')[0] + fext
-            with open(os.path.join(output_location, "tmp" + fext), "wb") as output:
-                if not dry:
-                    output.write(binary)
-                for key in songs.keys():
-                    parts = fname.split("O_")
-                    if parts[len(parts)-1].lower() == key+fext:
-                        song_name = os.path.join(output_location, key + file_type)
-                        sanitized_name = key
-                        volume = 1
-                        title = ""
-                        artist = ""
-                        album = ""
-                        track = ""
-                        track_num = ""
-                        disc_num = ""
-                        order_prefix = ""
-                        release_date = ""
-                        fade_length = "10" 
-                        if no_fade:
-                            fade_length = "0"
-                        if "track" in songs[key]:
-                            track = f' (Track {songs[key]["track"]})'
-                        if "title" in songs[key]:
-                            sanitized_name = sanitize_filename(songs[key]["title"] + track)
-                            order = get_track_number(sanitized_name)
-                            if not order == None:
-                                track_num = order["track"]
-                                disc_num = order["disc"]
-                                order_prefix = f'{disc_num}-{track_num} '
-                            song_name = os.path.join(output_location, order_prefix + sanitized_name + track + file_type)
-                            title = songs[key]["title"] + track
-                            album = 'Dr. Robotnik\'s Ring Racers'
-                            release_date = "2024-04-24T05:47:00-05:00"
-                        if "usage" in songs[key]:
-                            sanitized_name = sanitize_filename(songs[key]["source"].split('_-_')[0].replace('_', ' '))
-                            artist = songs[key]["source"].split('_-_')[1].replace('_', ' ')
-                            order = get_track_number(songs[key]['usage'])
-                            if not order == None:
-                                track_num = order["track"]
-                                disc_num = order["disc"]
-                                order_prefix = f'{disc_num}-{track_num} '
-                            song_name = os.path.join(output_location, order_prefix + sanitized_name + track + file_type)
-                            title = songs[key]["source"].split('_-_')[0].replace('_', ' ')
-                            album = 'SRB2Kart'
-                            release_date = "2018"
-                        if "volume" in songs[key] and not original_volume:
-                            volume = int(songs[key]["volume"].split(' #')[0])/100.0
-                        if "author" in songs[key]:
-                            artist = songs[key]["author"]
-                        if "originalcomposers" in songs[key]:
-                            if not artist == "":
-                                artist += ", "
-                            artist += songs[key]["originalcomposers"]
-                        command1 = [
-                                "vgmstream-cli",
-                                "-o", os.path.join(output_location, "tmp.wav"),
-                                "-l", f'{loop_count}',
-                                "-f", fade_length,
-                                os.path.join(output_location, "tmp" + fext)
-                        ]
-                        command2 = [
-                                "ffprobe",
-                                "-v", "error",
-                                "-select_streams", "a:0",
-                                "-show_entries", "stream=sample_rate",
-                                "-of", "default=noprint_wrappers=1:nokey=1",
-                                os.path.join(output_location, "tmp.wav")
-                        ]
-                        if verbose:
-                            cols = shutil.get_terminal_size().columns
-                            print("=" * cols)
-                        print(f'[{progress}/{len(music_list)}]','Converting: \t', fparts[0]+fext, '=>', song_name)
-                        progress+=1
-                        if verbose:
-                            print(key, json.dumps(songs[key], indent=4))
-                        if dry:
-                            continue
+    variants = get_variants(args)
+    for variant in variants:
+        os.makedirs(os.path.join(output_location, variant["folder"]), exist_ok=True)
+
+    report = match_music_lumps(music_list, songs)
+    if args.dry_run:
+        print_match_report(report)
+
+    plan = plan_music(pk3, report["matches"], songs, variants, args)
+    for (progress, job) in enumerate(plan, 1):
+        job.update({"progress": progress, "total": len(music_list), "definition": songs[job["key"]]})
+
+    manifest = Manifest(output_location)
+    control = JobControl()
+    stats.mark_setup()
+    try:
+        if jobs > 1:
+            # Songs run concurrently but their logs are printed in plan order
+            with ThreadPoolExecutor(jobs) as executor:
+                def stop(future):
+                    # Cancel everything as soon as any song fails, not once
+                    # the songs before it in the plan have finished
+                    if not future.cancelled() and future.exception() is not None and not isinstance(future.exception(), Cancelled):
+                        control.cancel()
+                        executor.shutdown(wait=False, cancel_futures=True)
+                futures = [executor.submit(run_job_buffered, pk3, job, args, control, manifest, stats) for job in plan]
+                for future in futures:
+                    future.add_done_callback(stop)
+                try:
+                    error = None
+                    for future in futures:
                         try:
-                            if verbose:
-                                print("Running: \t", ' '.join(command1))
-                            subprocess.run(command1, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                            if verbose:
-                                print("Running: \t", ' '.join(command2))
-                            result = subprocess.run(command2, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                            sample_rate = result.stdout.strip()
-                            if verbose:
-                                print("Sample Rate: \t", sample_rate)
-                            asetrate = f',asetrate={sample_rate}*{encore_sample_rate_multiplier}' if encore_mode else ''
-                            command3 = [
-                                    "ffmpeg",
-                                    "-i", os.path.join(output_location, "tmp.wav"),
-                                    "-metadata", f'title={title}',
-                                    "-metadata", f'artist={artist}',
-                                    "-metadata", f'track={track_num}',
-                                    "-metadata", f'disc={disc_num}',
-                                    "-metadata", f'date={release_date}',
-                                    "-metadata", f'album_artist=Kart Krew',
-                                    "-metadata", f'album={album}',
-                                    "-filter:a", f'volume={volume}{asetrate}',
-                                    "-y",
-                                    "-q:a", "0",
-                                    song_name
-                            ]
-                            if verbose:
-                                print("Running: \t", ' '.join(command3))
-                            subprocess.run(command3, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                            os.remove(os.path.join(output_location, "tmp.wav"))
-                            if verbose:
-                                print('done')
+                            lines = future.result()
+                        except CancelledError:
+                            continue
                         except Exception as e:
-                            print('Error: ', "Could not convert with vgmstream-cli")
-                            print('Warning: ',"Falling back to ffmpeg")
-                            try:
-                                command2 = [
-                                        "ffprobe",
-                                        "-v", "error",
-                                        "-select_streams", "a:0",
-                                        "-show_entries", "stream=sample_rate",
-                                        "-of", "default=noprint_wrappers=1:nokey=1",
-                                        os.path.join(output_location, "tmp"+fext)
-                                ]
-                                if verbose:
-                                    print("Running: \t", ' '.join(command2))
-                                result = subprocess.run(command2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                                sample_rate = result.stdout.strip()
-                                if verbose:
-                                    print("Sample Rate: \t", sample_rate)
-                                asetrate = f',asetrate={sample_rate}*{encore_sample_rate_multiplier}' if encore_mode else ''
-                                # print("Sample Rate:", sample_rate)
-                                command3 = [
-                                        "ffmpeg",
-                                        "-i", os.path.join(output_location, "tmp"+fext),
-                                        "-metadata", f'title={title}',
-                                        "-metadata", f'artist={artist}',
-                                        "-metadata", f'track={track_num}',
-                                        "-metadata", f'disc={disc_num}',
-                                        "-metadata", f'date={release_date}',
-                                        "-metadata", f'album_artist=Kart Krew',
-                                        "-metadata", f'album={album}',
-                                        "-filter:a", f'volume={volume}{asetrate}',
-                                        "-y",
-                                        "-q:a", "0",
-                                        song_name
-                                ]
-                                if verbose:
-                                    print("Running: \t", ' '.join(command3))
-                                subprocess.run(command3, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                                if verbose:
-                                    print('done')
-                            except:
-                                print('Error: \t', 'Could not convert with ffmpeg. Exiting program')
-                                sys.exit(0)
-                        # break
-
-            os.remove(os.path.join(output_location, "tmp"+fext))
+                            lines = getattr(e, 'lines', [])
+                            # Report the failure itself rather than the songs
+                            # it cancelled
+                            if error is None or isinstance(error, Cancelled):
+                                error = e
+                        for line in lines:
+                            print(*line)
+                    if error:
+                        raise error
+                except BaseException:
+                    control.cancel()
+                    executor.shutdown(cancel_futures=True)
+                    raise
+        else:
+            for job in plan:
+                run_job(pk3, job, args, control, manifest, stats, print)
+    except ConversionError as e:
+        print('Error: \t', f'{e}. Exiting program')
+        sys.exit(0)
+    finally:
+        if args.profile or args.stats_json:
+            stats_report = stats.report(args)
+            if args.profile:
+                print_stats(stats_report)
+            if args.stats_json:
+                with open(args.stats_json, 'w') as f:
+                    json.dump(stats_report, f, indent=4)
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
@@ -818,22 +846,30 @@ if __name__ == "__main__":
     parser.add_argument('output_location', type=str, help='The location to output the extracted music')
     
     # Optional arguments
+    parser.add_argument('-c', '--catalog', action='append', default=[], help='Extra album catalog JSON (same layout as album_catalog.json) used for disc and track numbers; may be repeated')
     parser.add_argument('-d', '--dry-run', action='store_true', help='Skip outputting any files (default: False)')
     parser.add_argument('-e', '--encore', action='store_true', help='Output Encore Mode Tuning (default: False)')
-    parser.add_argument('-f', '--file-type', type=str, default='mp3', help='Specify the output file type (default: mp3)')
-    parser.add_argument('-l', '--loop-count', type=valid_positive_int, default=1, help='Number of times the song loops (default: 1)')
+    parser.add_argument('--force', action='store_true', help='Convert every song even if the output manifest says it is up to date (default: False)')
+    parser.add_argument('-E', '--with-encore', action='store_true', help='Output both the normal and the Encore Mode Tuning of every song (default: False)')
+    parser.add_argument('-f', '--file-type', type=str, default='mp3', help='Specify the output file type, or a comma separated list of them, e.g. mp3,ogg (default: mp3)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of songs to convert in parallel, 0 for one per CPU (default: 1)')
+    parser.add_argument('-l', '--loop-count', type=valid_positive_int_list, default=[1], help='Number of times the song loops, or a comma separated list of loop counts (default: 1)')
     parser.add_argument('-n', '--no-fade', action='store_true', help='Skip fade out at end of song (default: False)')
+    parser.add_argument('--profile', action='store_true', help='Print wall time, CPU time and bytes in/out per stage and the slowest songs when done (default: False)')
+    parser.add_argument('--stats-json', type=str, metavar='PATH', help='Write per song and per stage timings, CPU time and bytes in/out to PATH as JSON (default: None)')
     parser.add_argument('-o', '--original-volume', action='store_true', help='Skip game defined volume adjustments and output at source volume (default: False)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Show more detailed logs (default: False)')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore and do not update the on-disk archive index cache (default: False)')
     
     args = parser.parse_args()
 
     addon = args.addon
+    cache_dir = False if args.no_cache else None
 
     if Path(addon).suffix == ".pk3":
-        with zipfile.ZipFile(addon, 'r') as pk3:
-            extract_music(pk3, args)
+        with Pk3File(addon, 'r') as pk3, IndexCache(pk3, addon, cache_dir) as cache:
+            extract_music(pk3, args, cache)
     if Path(addon).suffix == ".wad" or Path(addon).suffix == ".kart":
-        wad = WadFile(open(addon, 'rb'))
-        extract_music(wad, args)
+        with WadFile(filename=addon) as wad, IndexCache(wad, addon, cache_dir) as cache:
+            extract_music(wad, args, cache)
     # Now you can access the arguments using args
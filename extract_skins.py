@@ -1,13 +1,17 @@
 #!/bin/env python3
-import sys
 import zipfile
 import os
 import re
-import struct
 import io
+import contextlib
+import argparse
 import subprocess, json
+import math
 from PIL import Image
 from pathlib import Path
+from archive import Pk3File, WadFile, ArchiveIndex, IndexCache, open_archive
+import workers
+from graphics import decode_patch, indexed_image, format_list, save_formats, scale_list, scale_suffix
 
 skincolors = {
         "white":          [  0,   0,   0,   0,   1,   2,   5,   8,   9,  11,  14,  17,  20,  22,  25,  28],
@@ -167,29 +171,6 @@ def get_lua_skincolors(path=None, file=None):
   
 # print(get_lua_skincolors("test.lua"))
 
-class WadFile(object):
-    def __init__(self, source=None, filename=None):
-        self._files = {}
-        if not source:
-            source = open(filename, 'rb')
-        self._source = source
-        header = source.read(12)
-        (magic, numFiles, dirOffset) = struct.unpack('<III', header)
-        source.seek(dirOffset)
-        for i in range(numFiles):
-            dirent = source.read(16)
-            (pos, size, name) = struct.unpack('<II8s', dirent)
-            name = name.replace(b'\0', b'').decode()
-            self._files[name] = { "pos": pos, "size": size }
-
-    def namelist(self):
-        return self._files.keys()
-    
-    def open(self, name, mode='r'):
-        dirent = self._files[name]
-        self._source.seek(dirent['pos'])
-        return io.BytesIO(self._source.read(dirent['size']))
-
 def extract_startcolor(pk3, file_path):
     try:
         with pk3.open(os.path.join(file_path, 'S_SKIN')) as file:
@@ -253,124 +234,220 @@ def extract_name(pk3, character_folder):
         print("File not found.")
         return character_folder
 
-def convert_doom_to_png(bios, image, output_location, startcolor, color, size, default = False):
-    palette = []
+def read_playpal(bios):
     with bios.open('PLAYPAL', 'r') as f:
-        for i in range(256):
-            [r, g, b] = f.read(3)
-            palette.append([r, g, b])
-    colormap = list(range(256))
+        return f.read(768)
+
+class SkinPalettes(object):
+    """
+    Every skincolor ramp remapped onto PLAYPAL, precomputed as one table of
+    768-byte palettes per startcolor so a palette is a slice lookup.
+    """
+    def __init__(self, playpal, colors=skincolors):
+        self._playpal = bytes(playpal)
+        self._rows = {}
+        self._ramps = []
+        self._tables = {}
+        self.add(colors)
+
+    def _remap(self, startcolor, ramp):
+        pal = bytearray(self._playpal)
+        for (i, index) in enumerate(ramp[:256 - startcolor]):
+            dest = (startcolor + i) * 3
+            index = int(index) * 3
+            pal[dest:dest + 3] = self._playpal[index:index + 3]
+        return pal
+
+    def add(self, colors):
+        """Add or replace ramps, updating any tables already built."""
+        for (name, ramp) in colors.items():
+            ramp = list(ramp)
+            if name in self._rows:
+                row = self._rows[name]
+                self._ramps[row] = ramp
+                for (startcolor, table) in self._tables.items():
+                    table[row * 768:(row + 1) * 768] = self._remap(startcolor, ramp)
+            else:
+                self._rows[name] = len(self._ramps)
+                self._ramps.append(ramp)
+                for (startcolor, table) in self._tables.items():
+                    table += self._remap(startcolor, ramp)
+
+    def table(self, startcolor):
+        if startcolor not in self._tables:
+            table = bytearray()
+            for ramp in self._ramps:
+                table += self._remap(startcolor, ramp)
+            self._tables[startcolor] = table
+        return self._tables[startcolor]
 
-    # Open the Doom image file in binary mode
+    def palette(self, startcolor, color):
+        row = self._rows[color]
+        return bytes(self.table(startcolor)[row * 768:(row + 1) * 768])
+
+def read_skin(image):
+    # Read the whole Doom image
     f = image
     f.seek(0)
-    # Read width, height, left, and top from the Doom image
-    width = int.from_bytes(f.read(2), byteorder='little')
-    height = int.from_bytes(f.read(2), byteorder='little')
-    left = int.from_bytes(f.read(2), byteorder='little')
-    top = int.from_bytes(f.read(2), byteorder='little')
-
-    # Create column_array with width number of elements
-    column_array = [0] * width
-
-    # Read column_array from the Doom image
-    for i in range(width):
-        column_array[i] = int.from_bytes(f.read(4), byteorder='little')
-
-    # Create a new image with 8-bit pixel format and Doom palette
-    doom_image = Image.new('P', (width, height))
-    scolor = startcolor
-    for i in skincolors[color]:
-        colormap[scolor] = i
-        scolor += 1
-    pal = []
-    for i in colormap:
-        pal.append(palette[i][0])
-        pal.append(palette[i][1])
-        pal.append(palette[i][2])
+    (width, height, left, top, pixels) = decode_patch(f.read())
+
+    # Palette indices only; the skin color is applied when saving
+    return indexed_image(width, height, pixels)
+
+def scale_skin(doom_image, size):
+    # Paletted images always resize with nearest neighbour, so scaling the
+    # indices first gives the same result as scaling each recolored image
+    return doom_image.resize((32 * size, 32 * size), Image.BILINEAR)
+
+def decode_skin(image, size):
+    return scale_skin(read_skin(image), size)
+
+def save_skin(doom_image, pal, output_path):
     doom_image.putpalette(pal)
+    doom_image.save(output_path)
+    return output_path
 
-    # Read pixels from the Doom image and write to the PNG image
-    for i in range(width):
-        f.seek(column_array[i])
-        rowstart = 0
-        while rowstart != 255:
-            rowstart = int.from_bytes(f.read(1), byteorder='little')
-            if rowstart == 255:
-                break
-            pixel_count = int.from_bytes(f.read(1), byteorder='little')
-            dummy_value = int.from_bytes(f.read(1), byteorder='little')
-            for j in range(pixel_count):
-                pixel = int.from_bytes(f.read(1), byteorder='little')
-                doom_image.putpixel((i, j + rowstart), pixel)
-            dummy_value = int.from_bytes(f.read(1), byteorder='little')
+def save_atlas(doom_image, palettes, startcolor, colors, default, folder_path, suffix='', formats=('png',)):
+    """
+    Pack every color variant into one RGB image laid out in a near-square
+    grid, plus a JSON manifest mapping each color to its rectangle.
+    """
+    (width, height) = doom_image.size
+    columns = math.ceil(math.sqrt(len(colors)))
+    rows = math.ceil(len(colors) / columns)
+    atlas = Image.new('RGB', (columns * width, rows * height))
+    frames = {}
+    for (i, color) in enumerate(colors):
+        (x, y) = ((i % columns) * width, (i // columns) * height)
+        doom_image.putpalette(palettes.palette(startcolor, color))
+        atlas.paste(doom_image.convert('RGB'), (x, y))
+        frames[color] = {"x": x, "y": y, "w": width, "h": height}
+    frames["default"] = frames[default]
+    output_paths = save_formats(atlas, os.path.join(folder_path, 'atlas' + suffix), formats)
+    manifest_path = os.path.join(folder_path, 'atlas' + suffix + '.json')
+    manifest = {
+        "image": os.path.basename(output_paths[0]),
+        "width": atlas.width,
+        "height": atlas.height,
+        "default": default,
+        "frames": frames,
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return output_paths + [manifest_path]
+
+def convert_doom_to_png(bios, image, output_location, startcolor, color, size, default = False, palettes=None):
+    # Pass in the SkinPalettes of a whole run rather than rebuilding every
+    # palette for each sprite
+    if palettes is None:
+        palettes = SkinPalettes(read_playpal(bios))
+    doom_image = decode_skin(image, size)
 
     # Save the PNG image
     output_path = os.path.join(output_location, color + '.png')
     if (default):
         output_path = os.path.join(output_location, 'default' + '.png')
-    resized_image = doom_image.resize((32 * size, 32 * size), Image.BILINEAR)
-    resized_image.save(output_path)
-    print(output_path)
-
-def open_addon(bios, addon, output_location, size):
-    # Get the list of all files and directories in the zip archive
-    all_entries = addon.namelist()
-
-    # Set to collect unique folder names
-    folder_set = set()
-
-    for entry in all_entries:
-        if entry.endswith('S_SKIN'):
-            # Handle root directory case
-            if '/' in entry:
-                folder_name = '/'.join(entry.split('/')[:-1])  # Get the directory path
-            else:
-                folder_name = ''
-            folder_set.add(folder_name)
-        if Path(entry).suffix.lower() == ".lua":
-            for obj in get_lua_skincolors(file=addon.open(entry)).values():
-                skincolors[obj['name'].lower()] = list(obj['ramp'].values())
-    # Iterate over each file and directory in the zip archive
-    # for entry in all_entries:
-    #     # Check if the entry is a directory within the specified parent directory
-    #     if entry.startswith(parent_directory) and '/' in entry[len(parent_directory):]:
-    #         folder_name = os.path.dirname(entry)[len(parent_directory):]
-    #         folder_set.add(folder_name)
-
-    # Convert the set of folder names to a list
-    folder_list = list(folder_set)
+    print(save_skin(doom_image, palettes.palette(startcolor, color), output_path))
+
+def extract_character(addon, folder_name, palettes, output_location, sizes, atlas=False, formats=('png',)):
+    character_name = extract_name(addon, folder_name).lower()
+    folder_path = os.path.join(output_location, "characters", character_name.lower())
+    os.makedirs(folder_path, exist_ok=True)
+    # Decode once per character, scale once per size, then only swap palettes
+    with addon.open(os.path.join(folder_name, 'XTRAB0'), 'r') as image:
+        skin_image = read_skin(image)
+    startcolor = extract_startcolor(addon, folder_name)
+    c = extract_prefcolor(addon, folder_name)
+    output_paths = []
+    for size in sizes:
+        doom_image = scale_skin(skin_image, size)
+        suffix = scale_suffix(size, sizes)
+        if atlas:
+            output_paths += save_atlas(doom_image, palettes, startcolor, list(skincolors), c, folder_path, suffix, formats)
+            continue
+        for color in skincolors:
+            doom_image.putpalette(palettes.palette(startcolor, color))
+            output_paths += save_formats(doom_image, os.path.join(folder_path, color + suffix), formats)
+        doom_image.putpalette(palettes.palette(startcolor, c))
+        output_paths += save_formats(doom_image, os.path.join(folder_path, 'default' + suffix), formats)
+    return output_paths
+
+def open_character_worker(addon_path, playpal, colors, output_location, sizes, atlas, formats):
+    # Bring over the merged Lua skincolors in the parent's order and open a
+    # private archive handle
+    skincolors.clear()
+    skincolors.update(colors)
+    return {'addon': open_archive(addon_path), 'palettes': SkinPalettes(playpal), 'args': (output_location, sizes, atlas, formats)}
+
+def extract_character_job(folder_name):
+    # Hand what extract_character would have printed back with the paths, so
+    # the parent can print both in the same order as a serial run
+    with contextlib.redirect_stdout(io.StringIO()) as messages:
+        output_paths = extract_character(workers.state['addon'], folder_name, workers.state['palettes'], *workers.state['args'])
+    return (messages.getvalue(), output_paths)
+
+def open_addon(bios, addon, output_location, sizes, cache=None, jobs=1, atlas=False, formats=('png',)):
+    # Directory tree of the archive (the root folder is '')
+    index = cache.index() if cache else ArchiveIndex(addon.namelist())
+
+    playpal = read_playpal(bios)
+    palettes = SkinPalettes(playpal)
+
+    for entry in index.with_suffix(".lua"):
+        load = lambda: get_lua_skincolors(file=addon.open(entry))
+        lua_skincolors = cache.table('skincolors', entry, load) if cache else load()
+        added = {}
+        for obj in lua_skincolors.values():
+            added[obj['name'].lower()] = list(obj['ramp'].values())
+        skincolors.update(added)
+        palettes.add(added)
+
+    folder_list = index.folders_containing('S_SKIN')
 
     os.makedirs(os.path.join(output_location, "characters"), exist_ok=True)
 
+    if jobs > 1:
+        # One character per task; map() hands results back in order
+        with workers.process_pool(jobs, open_character_worker, addon.filename, playpal, dict(skincolors), output_location, sizes, atlas, formats) as executor:
+            for (messages, output_paths) in executor.map(extract_character_job, folder_list):
+                print(messages, end='')
+                for output_path in output_paths:
+                    print(output_path)
+        return
+
     # Print the list of folder names
     for folder_name in folder_list:
-        character_name = extract_name(addon, folder_name).lower()
-        folder_path = os.path.join(output_location, "characters", character_name.lower())
-        os.makedirs(folder_path, exist_ok=True)
-        with addon.open(os.path.join(folder_name, 'XTRAB0'), 'r') as image:
-            startcolor = extract_startcolor(addon, folder_name)
-            for color in skincolors:
-                convert_doom_to_png(bios, image, folder_path, startcolor, color, size)
-            c = extract_prefcolor(addon, folder_name)
-            convert_doom_to_png(bios, image, folder_path, startcolor, c, size, True)
+        for output_path in extract_character(addon, folder_name, palettes, output_location, sizes, atlas, formats):
+            print(output_path)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 4 or len(sys.argv) > 5:
-        print("Usage: python extract_skins.py <bios.pk3 file> <character pack> <output folder> <size multiplier>")
-        sys.exit(1)
-    bios_arg = sys.argv[1]
-    addon = sys.argv[2]
-    output_location = sys.argv[3]
-    size = 1 if len(sys.argv) == 4 else int(sys.argv[4])
+    parser = argparse.ArgumentParser(description="Extract character skin previews from a character pack.")
+    parser.add_argument('bios', type=str, help='The bios.pk3 file')
+    parser.add_argument('addon', type=str, help='The character pack (.pk3 or .wad)')
+    parser.add_argument('output_location', type=str, help='The location to output the extracted images')
+    parser.add_argument('size', type=scale_list, nargs='?', default=[1], help='Size multiplier, or a comma separated list of them to save every size from one decode, e.g. 1,2,4 (default: 1)')
+    parser.add_argument('-f', '--format', type=format_list, default=['png'], help='Image format, or a comma separated list of them, e.g. png,webp (default: png)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of characters to extract in parallel, 0 for one per CPU (default: 1)')
+    parser.add_argument('-a', '--atlas', action='store_true', help='Pack all colors of a character into one atlas.png with an atlas.json manifest instead of one PNG per color (default: False)')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore and do not update the on-disk archive index cache (default: False)')
+    args = parser.parse_args()
+
+    bios_arg = args.bios
+    addon = args.addon
+    output_location = args.output_location
+    sizes = args.size
+    formats = args.format
+    jobs = args.jobs or os.cpu_count()
+    atlas = args.atlas
+    cache_dir = False if args.no_cache else None
     # for color in skincolors:
     #     convert_doom_to_png(doom_file, output_location, color)
     with zipfile.ZipFile(bios_arg, 'r') as bios:
         print(Path(addon).suffix)
 
         if Path(addon).suffix == ".pk3":
-            with zipfile.ZipFile(addon, 'r') as pk3:
-                open_addon(bios, pk3, output_location, size)
+            with Pk3File(addon, 'r') as pk3, IndexCache(pk3, addon, cache_dir) as cache:
+                open_addon(bios, pk3, output_location, sizes, cache, jobs, atlas, formats)
         if Path(addon).suffix == ".wad":
-            wad = WadFile(open(addon, 'rb'))
-            open_addon(bios, wad, output_location, size)
+            with WadFile(filename=addon) as wad, IndexCache(wad, addon, cache_dir) as cache:
+                open_addon(bios, wad, output_location, sizes, cache, jobs, atlas, formats)
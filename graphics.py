@@ -0,0 +1,97 @@
+import struct
+from PIL import Image
+
+PATCH_HEADER = struct.Struct('<HHhh')
+
+
+def decode_patch(data):
+    """
+    Decode a Doom patch (column offsets followed by posts) from a bytes-like
+    object in one pass. Returns (width, height, left, top, pixels) where
+    pixels is a row-major bytearray of palette indices, 0 where transparent.
+    """
+    view = memoryview(data)
+    (width, height, left, top) = PATCH_HEADER.unpack_from(view, 0)
+    column_array = struct.unpack_from('<%dI' % width, view, PATCH_HEADER.size)
+    pixels = bytearray(width * height)
+    end = len(view)
+    for (i, pos) in enumerate(column_array):
+        while pos < end:
+            rowstart = view[pos]
+            if rowstart == 255:
+                break
+            pixel_count = view[pos + 1]
+            # Skip the post header and its leading padding byte
+            start = pos + 3
+            count = min(pixel_count, height - rowstart, end - start)
+            if count > 0:
+                # Write the whole post down column i with one strided slice
+                first = rowstart * width + i
+                pixels[first:first + count * width:width] = view[start:start + count]
+            # Skip the post data and its trailing padding byte
+            pos = start + pixel_count + 1
+    return (width, height, left, top, pixels)
+
+
+def indexed_image(width, height, pixels, palette=None):
+    image = Image.frombuffer('P', (width, height), pixels, 'raw', 'P', 0, 1)
+    if palette is not None:
+        image.putpalette(palette)
+    return image
+
+
+# Extra save() arguments per format; thumbnails are pixel art, so WebP is
+# kept lossless
+SAVE_OPTIONS = {
+    'webp': {'lossless': True},
+}
+
+
+def scale_list(value):
+    """Parse a comma separated list of size multipliers, e.g. '1,2,4'."""
+    scales = []
+    for item in value.split(','):
+        scale = int(item)
+        if scale < 1:
+            raise ValueError('scales must be 1 or more')
+        if scale not in scales:
+            scales.append(scale)
+    return scales
+
+
+def format_list(value):
+    """Parse a comma separated list of image formats Pillow can write, e.g. 'png,webp'."""
+    Image.init()
+    formats = []
+    for item in value.lower().split(','):
+        item = item.strip().lstrip('.')
+        if Image.registered_extensions().get('.' + item) not in Image.SAVE:
+            raise ValueError('unsupported image format %s' % item)
+        if item not in formats:
+            formats.append(item)
+    return formats
+
+
+def scale_suffix(scale, scales):
+    # Only tell sizes apart in the file name when more than one is made
+    return '@%dx' % scale if len(scales) > 1 else ''
+
+
+def save_formats(image, stem, formats=('png',)):
+    """
+    Save image as stem plus each format's extension, returning the paths.
+    Formats that can't store the image's mode (JPEG has neither palettes nor
+    alpha) get it converted to RGBA, or failing that RGB.
+    """
+    paths = []
+    for format in formats:
+        path = stem + '.' + format
+        for mode in (None, 'RGBA', 'RGB'):
+            try:
+                (image.convert(mode) if mode else image).save(path, **SAVE_OPTIONS.get(format, {}))
+                break
+            except OSError:
+                if mode == 'RGB':
+                    raise
+        paths.append(path)
+    return paths
@@ -0,0 +1,165 @@
+import struct
+import zlib
+
+# capture pattern, version, header type, granule position, serial number,
+# page sequence number, CRC, segment count
+PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+CONTINUED = 0x01
+BOS = 0x02
+EOS = 0x04
+MAX_SEGMENTS = 255
+
+_REVERSED_BITS = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def crc(data):
+    """
+    Ogg's CRC-32: polynomial 0x04c11db7 with no reflection, no initial value
+    and no final xor. zlib only has the reflected variant, so it is run over
+    the bit-reversed bytes and its (un-xored) result reversed back.
+    """
+    value = zlib.crc32(bytes(data).translate(_REVERSED_BITS), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int('{:032b}'.format(value)[::-1], 2)
+
+
+def read_page(stream):
+    """Read the next page as (header fields, segment table, body), None at the end."""
+    header = stream.read(PAGE_HEADER.size)
+    if not header:
+        return None
+    if len(header) < PAGE_HEADER.size or header[:4] != b'OggS':
+        raise ValueError('Not an Ogg page')
+    fields = list(PAGE_HEADER.unpack(header))
+    segments = stream.read(fields[7])
+    body = stream.read(sum(segments))
+    if len(segments) < fields[7] or len(body) < sum(segments):
+        raise ValueError('Truncated Ogg page')
+    return (fields, segments, body)
+
+
+def write_page(stream, fields, segments, body):
+    fields = list(fields)
+    fields[6] = 0
+    fields[7] = len(segments)
+    page = PAGE_HEADER.pack(*fields) + bytes(segments) + body
+    fields[6] = crc(page)
+    stream.write(PAGE_HEADER.pack(*fields))
+    stream.write(segments)
+    stream.write(body)
+
+
+def split_packets(pages):
+    """
+    Packets laced across the (segments, body) pairs of consecutive pages.
+    A trailing unfinished packet is left out.
+    """
+    packets = []
+    packet = b''
+    for (segments, body) in pages:
+        pos = 0
+        for size in segments:
+            packet += body[pos:pos + size]
+            pos += size
+            if size < 255:
+                packets.append(packet)
+                packet = b''
+    return packets
+
+
+def paginate(packets, serial, sequence):
+    """Lay header packets out over as few pages as possible."""
+    lacing = []
+    for packet in packets:
+        pos = 0
+        for size in [255] * (len(packet) // 255) + [len(packet) % 255]:
+            lacing.append((size, packet[pos:pos + size]))
+            pos += size
+    pages = []
+    continued = False
+    for start in range(0, len(lacing), MAX_SEGMENTS):
+        run = lacing[start:start + MAX_SEGMENTS]
+        segments = bytes(size for (size, data) in run)
+        body = b''.join(data for (size, data) in run)
+        # Headers have granule position 0, but a page on which no packet
+        # ends has none at all
+        granule = 0 if any(size < 255 for (size, data) in run) else -1
+        fields = [b'OggS', 0, CONTINUED if continued else 0, granule, serial, sequence + len(pages), 0, 0]
+        pages.append((fields, segments, body))
+        continued = run[-1][0] == 255
+    return pages
+
+
+def parse_comments(packet):
+    if packet[:7] != b'\x03vorbis':
+        raise ValueError('Not a Vorbis comment header')
+    pos = 7
+    (length,) = struct.unpack_from('<I', packet, pos)
+    vendor = packet[pos + 4:pos + 4 + length]
+    pos += 4 + length
+    (count,) = struct.unpack_from('<I', packet, pos)
+    pos += 4
+    comments = []
+    for i in range(count):
+        (length,) = struct.unpack_from('<I', packet, pos)
+        comments.append(packet[pos + 4:pos + 4 + length])
+        pos += 4 + length
+    return (vendor, comments)
+
+
+def build_comments(vendor, comments):
+    packet = b'\x03vorbis' + struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments))
+    for comment in comments:
+        packet += struct.pack('<I', len(comment)) + comment
+    # Framing bit
+    return packet + b'\x01'
+
+
+def retag_vorbis(source, destination, tags):
+    """
+    Copy the Ogg Vorbis stream read from source to destination with the
+    comments named in tags replaced (an empty value just removes the name).
+    Audio pages are copied untouched unless the new headers need a different
+    number of pages, in which case only their sequence numbers and CRCs are
+    rewritten. Raises ValueError for anything but a single Vorbis stream.
+    """
+    first = read_page(source)
+    if first is None or not first[0][2] & BOS or not first[2].startswith(b'\x01vorbis'):
+        raise ValueError('Not an Ogg Vorbis stream')
+    serial = first[0][4]
+
+    # The comment and setup headers, which end the last of their pages
+    header_pages = []
+    packets = []
+    while len(packets) < 2:
+        page = read_page(source)
+        if page is None or page[0][4] != serial:
+            raise ValueError('Ogg Vorbis headers are incomplete')
+        header_pages.append(page)
+        packets = split_packets([(segments, body) for (fields, segments, body) in header_pages])
+    if len(packets) > 2 or header_pages[-1][1][-1:] == b'\xff':
+        raise ValueError('Audio data shares a page with the Vorbis headers')
+
+    (vendor, comments) = parse_comments(packets[0])
+    names = {name.upper() for name in tags}
+    comments = [comment for comment in comments if comment.split(b'=', 1)[0].decode('ascii', 'replace').upper() not in names]
+    for (name, value) in tags.items():
+        if value != '':
+            comments.append(f'{name.upper()}={value}'.encode('utf-8'))
+    pages = paginate([build_comments(vendor, comments), packets[1]], serial, first[0][5] + 1)
+    shift = len(pages) - len(header_pages)
+
+    destination.write(PAGE_HEADER.pack(*first[0]) + first[1] + first[2])
+    for (fields, segments, body) in pages:
+        write_page(destination, fields, segments, body)
+    while True:
+        page = read_page(source)
+        if page is None:
+            break
+        (fields, segments, body) = page
+        if fields[4] != serial or fields[2] & BOS:
+            raise ValueError('Chained or multiplexed Ogg streams are not supported')
+        if shift:
+            fields[5] += shift
+            write_page(destination, fields, segments, body)
+        else:
+            destination.write(PAGE_HEADER.pack(*fields) + segments + body)
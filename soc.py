@@ -0,0 +1,78 @@
+import re
+from archive import lump_hash
+
+# Addon text lumps are mostly UTF-8, but older ones were saved in Windows'
+# code page; latin-1 never fails, so it is the last resort
+ENCODINGS = ('utf-8-sig', 'cp1252', 'latin-1')
+LUMP_SEPARATORS = re.compile(r'[,\s]+')
+
+
+def number_to_letter(n):
+    if 0 <= n < 26:
+        return chr(ord('A') + n)
+    else:
+        return None
+
+
+def decode_text(data):
+    for encoding in ENCODINGS:
+        try:
+            return bytes(data).decode(encoding)
+        except UnicodeDecodeError:
+            continue
+
+
+def parse_soc(text):
+    """
+    Parse SOC or MUSICDEF text in one pass into
+    {"levels": {name: fields}, "lumps": {name: fields}}.
+
+    Any line without '=' (other than a # comment) starts a new block, so
+    fields of blocks other than Level and Lump (Object, State, ...) are never
+    credited to the level above them. Names and keys are lowercased, values
+    are kept as written with only the surrounding whitespace removed. The
+    lumps of a multi-lump entry (Lump A,B) each get the fields plus a track
+    letter.
+    """
+    records = {"levels": {}, "lumps": {}}
+    current = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if '=' not in line:
+            words = line.split(None, 1)
+            keyword = words[0].lower()
+            current = []
+            if keyword == 'level' and len(words) > 1:
+                name = words[1].split()[0].lower()
+                records["levels"][name] = {}
+                current = [records["levels"][name]]
+            elif keyword == 'lump' and len(words) > 1:
+                names = [name for name in LUMP_SEPARATORS.split(words[1].lower().replace('\\', '')) if name]
+                for (i, name) in enumerate(names):
+                    fields = {}
+                    if len(names) > 1:
+                        fields["track"] = number_to_letter(i)
+                    records["lumps"][name] = fields
+                    current.append(fields)
+            continue
+        (key, value) = line.split('=', 1)
+        for fields in current:
+            fields[key.strip().lower()] = value.strip()
+    return records
+
+
+def read_soc(archive, name, cache=None):
+    """
+    Parsed records (see parse_soc()) of the SOC or MUSICDEF member name. With
+    an IndexCache they are kept under a hash of the member's contents, so an
+    unchanged file is never parsed twice, even after the rest of the addon
+    changed.
+    """
+    def build():
+        with archive.open(name) as f:
+            return parse_soc(decode_text(f.read()))
+    if cache is None:
+        return build()
+    return cache.content_table('soc', lump_hash(archive, name), build)
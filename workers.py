@@ -0,0 +1,20 @@
+from concurrent.futures import ProcessPoolExecutor
+
+# What the setup function passed to process_pool() returned, in each worker
+state = {}
+
+
+def _init(setup, args):
+    state.clear()
+    state.update(setup(*args))
+
+
+def process_pool(jobs, setup, *args):
+    """
+    ProcessPoolExecutor for the --jobs options. Each worker runs
+    setup(*args) once when it starts and keeps the dict it returns (open
+    archive handles, palettes, options) in state for the tasks it is given.
+    Workers may be spawned rather than forked, so setup must bring over
+    everything the tasks need.
+    """
+    return ProcessPoolExecutor(jobs, initializer=_init, initargs=(setup, args))